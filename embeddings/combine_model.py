@@ -50,6 +50,9 @@ nltk.download('punkt')
 # For loading functions from files in data_tools directory:
 import sys; sys.path.insert(0, "../../data_tools/")
 from clean_text import clean_sentence, stopwords_make, punctstr_make, unicode_make
+sys.path.insert(0, "../parsing/")
+from page_store import page_key # Page dedup keys
+from page_arena import build_arena, open_arena, arena_school # Shared memory-mapped page text for Pool workers
 import clean_text
 
 # ## Create lists of stopwords, punctuation, and unicode characters
@@ -73,6 +76,7 @@ phrasesent_path = "../../Charter-school-identities/data/wem_phrasesent_data_trai
 model_path = "../../Charter-school-identities/data/wem_model_train250_nostem_unlapped_300d_clean2.bin"
 vocab_path = "../../Charter-school-identities/data/wem_vocab_train250_nostem_unlapped_300d_clean2.txt"
 vocab_path_old = "../../Charter-school-identities/data/wem_vocab_train250_nostem_unlapped_300d_clean.txt"
+arena_path = "../../Charter-school-identities/data/doc2vec_webtext_arena" # Page text arena shared by Pool workers
 
 # Check if sentences data already exists, to save time
 try:
@@ -213,7 +217,7 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     global words_by_sentence # Grants access to variable holding a list of lists of words, where each list of words represents a sentence in its original order (only relevant for this function if we're not using multiprocessing)
     global pcount # Grants access to preprocessing counter
     
-    known_pages = set() # Initialize list of known pages for a school
+    known_pages = set() # Initialize set of keys of known pages for a school
 
     if type(tuplist)==float:
         return # Can't iterate over floats, so exit
@@ -221,7 +225,10 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     #print('Parsing school #' + str(pcount)) # Print number of school being parsed
 
     for tup in tuplist: # Iterate over tuples in tuplist (list of tuples)
-        if tup[3] in known_pages or tup=='': # Could use hashing to speed up comparison: hashlib.sha224(tup[3].encode()).hexdigest()
+        if tup=='':
+            continue
+        key = page_key(tup) # Integer content hash stored in the arena, or the page text itself
+        if key in known_pages:
             continue # Skip this page if exactly the same as a previous page on this school's website
 
         for chunk in tup[3].split('\n'): 
@@ -245,7 +252,7 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
                     words_by_sentence.append(sent) # If not multiprocessing, just add sent to object
                     
                     
-        known_pages.add(tup[3])
+        known_pages.add(key)
     
     pcount += 1 # Add to counter
     
@@ -382,7 +389,7 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     global sents_combined # Grants access to variable holding a list of lists of words, where each list of words represents a sentence in its original order (only relevant for this function if we're not using multiprocessing)
     global pcount # Grants access to preprocessing counter
     
-    known_pages = set() # Initialize list of known pages for a school
+    known_pages = set() # Initialize set of keys of known pages for a school
     sents_combined = [] # Initialize list of all school's sentences
 
     if type(tuplist)==float:
@@ -391,7 +398,10 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     #print('Parsing school #' + str(pcount)) # Print number of school being parsed
 
     for tup in tuplist: # Iterate over tuples in tuplist (list of tuples)
-        if tup[3] in known_pages or tup=='': # Could use hashing to speed up comparison: hashlib.sha224(tup[3].encode()).hexdigest()
+        if tup=='':
+            continue
+        key = page_key(tup) # Integer content hash stored in the arena, or the page text itself
+        if key in known_pages:
             continue # Skip this page if exactly the same as a previous page on this school's website
 
         for chunk in tup[3].split('\n'): 
@@ -410,7 +420,7 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
                 #sents_combined.append(sent) # add sent to object #if nested works
                 sents_combined.extend(sent) # if nested version doesnt work
                     
-        known_pages.add(tup[3])
+        known_pages.add(key)
         
     school_sentslist.append(sents_combined) # add sent to object
     
@@ -419,9 +429,20 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     return sents_combined
 
 
+def preprocess_wem_arena(row):
+    """Runs preprocess_wem() on school number row of the page arena opened by this worker.
+    Lets Pool() tasks carry a row index instead of a pickled list of page tuples."""
+    
+    return preprocess_wem(arena_school(row))
+
+
+# Preprocess schools in parallel: page text is written once to the arena and memory-mapped by every worker
+build_arena(arena_path, enumerate(df['WEBTEXT']))
+with Pool(numcpus, initializer=open_arena, initargs=(arena_path,)) as p:
+    docs = p.map(preprocess_wem_arena, range(len(df)))
+
 docs_tagged = []
-for school in df['WEBTEXT']:
-    doc = preprocess_wem(school)
+for doc in docs:
     T = gensim.models.doc2vec.TaggedDocument(doc,[''.join(doc)])
     docs_tagged.append(T)
     
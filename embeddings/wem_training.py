@@ -39,6 +39,9 @@ from gensim.models.phrases import Phrases # Makes word2vec more robust: Looks no
 # For loading functions from files in data_tools directory:
 import sys; sys.path.insert(0, "../../data_tools/")
 from clean_text import clean_sentence, stopwords_make, punctstr_make, unicode_make
+sys.path.insert(0, "../parsing/")
+from page_store import page_key # Page dedup keys
+from page_arena import build_arena, open_arena, arena_school # Shared memory-mapped page text for Pool workers
 import clean_text
 
 # ## Create lists of stopwords, punctuation, and unicode characters
@@ -72,6 +75,7 @@ phrasesent_path = "../data/wem_phrasesent_data_train250_nostem_unlapped_clean2.p
 model_path = "../data/wem_model_train250_nostem_unlapped_300d_clean2.bin"
 vocab_path = "../data/wem_vocab_train250_nostem_unlapped_300d_clean2.txt"
 vocab_path_old = "../data/wem_vocab_train250_nostem_unlapped_300d_clean.txt"
+arena_path = "../data/wem_webtext_arena" # Page text arena shared by Pool workers (only used if mpdo)
 
 # Check if sentences data already exists, to save time
 try:
@@ -214,7 +218,7 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     global words_by_sentence # Grants access to variable holding a list of lists of words, where each list of words represents a sentence in its original order (only relevant for this function if we're not using multiprocessing)
     global pcount # Grants access to preprocessing counter
     
-    known_pages = set() # Initialize list of known pages for a school
+    known_pages = set() # Initialize set of keys of known pages for a school
 
     if type(tuplist)==float:
         return # Can't iterate over floats, so exit
@@ -222,7 +226,10 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
     #print('Parsing school #' + str(pcount)) # Print number of school being parsed
 
     for tup in tuplist: # Iterate over tuples in tuplist (list of tuples)
-        if tup[3] in known_pages or tup=='': # Could use hashing to speed up comparison: hashlib.sha224(tup[3].encode()).hexdigest()
+        if tup=='':
+            continue
+        key = page_key(tup) # Integer content hash stored in the arena, or the page text itself
+        if key in known_pages:
             continue # Skip this page if exactly the same as a previous page on this school's website
 
         for chunk in tup[3].split('\n'): 
@@ -246,13 +253,20 @@ def preprocess_wem(tuplist): # inputs were formerly: (tuplist, start, limit)
                     words_by_sentence.append(sent) # If not multiprocessing, just add sent to object
                     
                     
-        known_pages.add(tup[3])
+        known_pages.add(key)
     
     pcount += 1 # Add to counter
     
     return
 
 
+def preprocess_wem_arena(row):
+    """Runs preprocess_wem() on school number row of the page arena opened by this worker.
+    Lets Pool() tasks carry a row index instead of a pickled list of page tuples."""
+    
+    return preprocess_wem(arena_school(row))
+
+
 print("Sentence cleaning preliminaries complete...")
 
 
@@ -285,13 +299,13 @@ else:
 
         # WITH multiprocessing (faster):
         if mpdo:
-            weblist = df["WEBTEXT"].tolist() # Convert DF into list to pass to Pool()
+            build_arena(arena_path, enumerate(df["WEBTEXT"])) # Write page text once; workers memory-map it instead of unpickling each school
 
             # Use multiprocessing.Pool(numcpus) to run preprocess_wem:
             print("Preprocessing web text into list of sentences...")
             if __name__ == '__main__':
-                with Pool(numcpus) as p:
-                    p.map(preprocess_wem, tqdm(weblist, desc="Tokenizing sentences")) 
+                with Pool(numcpus, initializer=open_arena, initargs=(arena_path,)) as p:
+                    p.map(preprocess_wem_arena, tqdm(range(len(df)), desc="Tokenizing sentences")) 
 
         # WITHOUT multiprocessing (much slower):
         else:
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Shared keyword scorer for page ranking
+# Project title: Charter school identities
+#
+# The page-ranking scripts score each page by its dictionary hits: every occurrence of every dictionary entry
+# (multi-word entries like 'our school began' included), weighted by the entry's value. This module builds that
+# scorer once from a dictionary file and compiles it into an Aho-Corasick automaton over words, so a page is
+# scored in one pass over its words, giving the same totals as the dict_count2 loops it replaced.
+#
+# Dictionary files have one entry per line, optionally followed by a tab and its weight (default 1), e.g.
+#     mission	2
+#     our school began	1
+# so the plain word lists in dictionary_methods/dicts/ load as they are.
+#
+# Usage:
+#     scorer = KeywordScorer.from_file("keywords_values.txt")
+#     hits = scorer.score(page_text)
+#     hits_list = scorer.score_many(page_texts)     # each distinct text scored once
+#     hits_array = scorer.score_batch(page_texts)   # whole corpus: sparse n-gram matrix times weight vector
+#
+# Batch mode turns every page into a row of a sparse matrix with one column per dictionary entry, counting the
+# entry's occurrences. N-grams (up to the longest entry) are coded exactly in base (dictionary words + 1) and looked up
+# among the sorted entry codes, so unlike a hashed vectorizer no two n-grams share a column and the scores equal
+# score(); n-grams that are not entries are dropped. The matrix can be kept and multiplied by other weight vectors
+# (weight_vector()) without re-reading the text.
+
+
+import re # For splitting text into words
+from collections import deque # For building failure links breadth first
+from itertools import repeat
+import numpy as np
+import scipy.sparse as sp # For batch scoring
+
+
+def top_k_by_group(scores, offsets, k):
+    """Returns the indexes of the k highest scores in each group, where group g holds scores[offsets[g]:offsets[g+1]]
+    (e.g. the pages of school g). Ties keep the earlier page. Output: one int array per group, best first."""
+
+    scores = np.asarray(scores)
+    offsets = np.asarray(offsets)
+    groups = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    order = np.lexsort((np.arange(len(scores)), -scores, groups)) # by group, then score descending, then position
+    rank = np.arange(len(order)) - offsets[groups[order]] # position of each page within its group's ranking
+    kept = order[rank < k]
+    return np.split(kept, np.searchsorted(groups[kept], np.arange(1, len(offsets) - 1)))
+
+
+class KeywordScorer:
+    """Weighted dictionary-hit scorer, compiled once and reused for every page.
+    lowercase and split_pattern set how text is split into words: the defaults match page_filter_replace.py;
+    old/filter_pages.py lowercases and also splits on underscores (split_pattern=r'\W+|_')."""
+
+    def __init__(self, weights, lowercase=False, split_pattern=r"\W+", cache=False):
+        self.weights = dict(weights)
+        self.lowercase = lowercase
+        self.word_split = re.compile(split_pattern)
+        self.scores = {} if cache else None # With cache=True, score_many() remembers every text it has scored
+        self.build_automaton()
+        self.build_codes()
+
+    @classmethod
+    def from_file(cls, dict_path, **kwargs):
+        """Builds a scorer from a dictionary file (entry, or entry<TAB>weight, per line)."""
+        weights = {}
+        with open(dict_path, encoding="utf-8") as dictfile:
+            for line in dictfile:
+                fields = line.rstrip("\n").split("\t")
+                entry = fields[0].strip()
+                if entry:
+                    weights[entry] = float(fields[1]) if len(fields) > 1 else 1
+                    if weights[entry] == int(weights[entry]):
+                        weights[entry] = int(weights[entry]) # Keep integer scores integers, as in keywords_values
+        return cls(weights, **kwargs)
+
+    def build_automaton(self):
+        """Builds per state: a dict word -> next state, the fallback state on a mismatch,
+        and the total weight of entries ending in that state."""
+
+        goto, fail, out = [{}], [0], [0]
+        for entry, weight in self.weights.items():
+            state = 0
+            for word in (entry.lower() if self.lowercase else entry).split():
+                if word not in goto[state]:
+                    goto[state][word] = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append(0)
+                state = goto[state][word]
+            out[state] += weight
+
+        queue = deque(goto[0].values()) # Breadth first, so every fallback state is done before it's used
+        while queue:
+            state = queue.popleft()
+            for word, child in goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and word not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(word, 0)
+                out[child] += out[fail[child]] # Entries that end here as a suffix of a longer match
+        self.goto, self.fail, self.out = goto, fail, out
+
+    def build_codes(self):
+        """Numbers dictionary words from 1 (0 stands for any other word) and codes every entry as an n-gram
+        in base len(words) + 1. Codes of different lengths fall in disjoint ranges, so codes are unique.
+        The distinct codes, sorted, are the columns of ngram_matrix(); entry_columns maps each entry to its column
+        (entries that only differ in case share one when lowercasing)."""
+
+        entry_words = [(entry.lower() if self.lowercase else entry).split() for entry in self.weights]
+        self.word_ids = {}
+        for words in entry_words:
+            for word in words:
+                self.word_ids.setdefault(word, len(self.word_ids) + 1)
+        self.base = len(self.word_ids) + 1
+        self.max_words = max([len(words) for words in entry_words], default=1)
+        if self.base ** self.max_words >= 2**62:
+            raise ValueError("Dictionary too large for exact int64 n-gram codes; use score() instead of batch scoring")
+        self.entry_codes = np.zeros(len(entry_words), dtype=np.int64)
+        for i, words in enumerate(entry_words):
+            for word in words:
+                self.entry_codes[i] = self.entry_codes[i] * self.base + self.word_ids[word]
+        self.column_codes, self.entry_columns = np.unique(self.entry_codes, return_inverse=True)
+
+    def ngram_matrix(self, texts):
+        """Returns a sparse (len(texts) x distinct entries) CSR matrix: row i counts the occurrences of each dictionary
+        entry in texts[i], in the column order of column_codes."""
+
+        # All texts go into one id array, each followed by a 0 so no n-gram spans two texts
+        get_id = self.word_ids.get
+        ids, lengths = [], []
+        separator = np.zeros(1, dtype=np.int64)
+        for text in texts:
+            words = self.word_split.split((text.lower() if self.lowercase else text) if text else "")
+            ids.append(np.fromiter(map(get_id, words, repeat(0)), dtype=np.int64, count=len(words)))
+            ids.append(separator)
+            lengths.append(len(words) + 1)
+        ids = np.concatenate(ids) if ids else separator[:0]
+        text_of = np.repeat(np.arange(len(texts)), lengths)
+
+        rows, codes = [], []
+        for n in range(1, self.max_words + 1):
+            width = len(ids) - n + 1
+            code = ids[:width].copy()
+            known = code > 0
+            for j in range(1, n):
+                code = code * self.base + ids[j:j + width]
+                known &= ids[j:j + width] > 0
+            codes.append(code[known])
+            rows.append(text_of[:width][known])
+        codes, rows = np.concatenate(codes), np.concatenate(rows)
+
+        # Map each n-gram to its entry's column; n-grams of dictionary words that are not entries are dropped
+        columns = np.minimum(np.searchsorted(self.column_codes, codes), max(len(self.column_codes) - 1, 0))
+        is_entry = self.column_codes[columns] == codes if len(self.column_codes) else np.zeros(len(codes), dtype=bool)
+        # Repeated (row, column) pairs are summed into counts
+        return sp.csr_matrix((np.ones(is_entry.sum(), dtype=np.int64), (rows[is_entry], columns[is_entry])),
+                             shape=(len(texts), len(self.column_codes)))
+
+    def weight_vector(self, weights=None):
+        """Returns the weight of each ngram_matrix() column, from a dict entry -> weight (by default this scorer's).
+        Entries sharing a column add up, as they do in score()."""
+
+        if weights is None:
+            weights = self.weights
+        entry_weights = np.array([weights.get(entry, 0) for entry in self.weights])
+        vector = np.zeros(len(self.column_codes), dtype=entry_weights.dtype if len(entry_weights) else np.int64)
+        np.add.at(vector, self.entry_columns, entry_weights)
+        return vector
+
+    def score_batch(self, texts, batch_size=10000):
+        """Scores every text as ngram_matrix(texts) @ weights. Returns an array with one score per text, equal to score().
+        Texts are processed batch_size at a time, to bound the memory held by the matrix."""
+
+        weights = self.weight_vector()
+        scores = []
+        for start in range(0, len(texts), batch_size):
+            scores.append(self.ngram_matrix(texts[start:start + batch_size]) @ weights)
+        return np.concatenate(scores) if scores else np.zeros(0, dtype=weights.dtype)
+
+    def score(self, text):
+        """Returns the total weight of dictionary hits in text."""
+
+        if not text:
+            return 0
+        if self.lowercase:
+            text = text.lower()
+        goto, fail, out = self.goto, self.fail, self.out
+        root = goto[0]
+        counts = 0
+        state = 0
+        for word in self.word_split.split(text):
+            if state == 0: # Fast path: most words are not the start of any entry
+                state = root.get(word, 0)
+            else:
+                while state and word not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(word, 0)
+            if state:
+                counts += out[state]
+        return counts
+
+    def score_many(self, texts):
+        """Returns the scores of texts, in order. Repeated texts (e.g. the same page under several schools)
+        are scored once."""
+
+        scores = self.scores if self.scores is not None else {}
+        results = []
+        for text in texts:
+            if text not in scores:
+                scores[text] = self.score(text)
+            results.append(scores[text])
+        return results
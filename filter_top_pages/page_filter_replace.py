@@ -1,32 +1,13 @@
 import pandas as pd
 import time
-import re
-import numpy as np
 import ast
 import sys
+sys.path.insert(0, "../parsing/")
+from page_store import page_key # page dedup keys
+from keyword_scorer import KeywordScorer
 
 
-keywords = ['values', 'academics', 'academic', 'skills', 'skill', 'purpose', 'purposes',
-                       'direction', 'mission', 'vision', 'visions', 'missions',
-                       'ideals', 'cause', 'causes', 'curriculum', 'curricular',
-                       'method', 'methods', 'pedagogy', 'pedagogical', 'pedagogies', 'approach', 'approaches', 'model', 'models', 'system', 'systems',
-                       'structure', 'structures', 'philosophy', 'philosophical', 'philosophies', 'beliefs', 'believe', 'belief',
-                       'principles', 'principle', 'creed', 'creeds', 'credo', 'moral', 'morals', 'morality', 'history', 'histories', 'our story',
-                       'the story', 'school story', 'background', 'backgrounds', 'founding', 'founded', 'foundation', 'foundations', 'foundational',
-                       'established','establishment', 'our school began', 'we began',
-                       'doors opened', 'school opened', 'about us', 'our school', 'who we are',
-                       'identity', 'identities', 'profile', 'highlights']
-
-keywords_values = {'values':2, 'academics':1, 'academic':1, 'skills':1, 'skill':1, 'purpose':2, 'purposes':2,
-                       'direction':1, 'mission':2, 'vision':2, 'visions':2, 'missions':2,
-                       'ideals':2, 'cause':1, 'causes':1, 'curriculum':2, 'curricular':2,
-                       'method':1, 'methods':1, 'pedagogy':2, 'pedagogical':1, 'pedagogies':1, 'approach':1, 'approaches':1, 'model':2, 'models':2, 'system':2, 'systems':2,
-                       'structure':1, 'structures':1, 'philosophy':2, 'philosophical':2, 'philosophies':2, 'beliefs':2, 'believe':2, 'belief':2,
-                       'principles':2, 'principle':2, 'creed':2, 'creeds':2, 'credo':2, 'moral':2, 'morals':2, 'morality':2, 'history':1, 'histories':1, 'our story':1,
-                       'the story':1, 'school story':1, 'background':1, 'backgrounds':1, 'founding':1, 'founded':1, 'foundation':1, 'foundations':1, 'foundational':1,
-                       'established':1,'establishment':1, 'our school began':1, 'we began':1,
-                       'doors opened':1, 'school opened':1, 'about us':2, 'our school':1, 'who we are':1,
-                       'identity':1, 'identities':1, 'profile':1, 'highlights':2}
+scorer = KeywordScorer.from_file('keywords_values.txt', cache=True) # shared, compiled page scorer (see keyword_scorer.py)
 charter_path = '../../charters_full_2015.pkl'
 df_charter = pd.read_pickle(charter_path)
 df_charter['WEBTEXT']=df_charter['WEBTEXT'].fillna('') # turn nan to empty list/string for future convenience
@@ -34,111 +15,119 @@ df_charter['CMO_WEBTEXT'] = df_charter['CMO_WEBTEXT'].fillna('0') # ugly hack so
 df_charter['CMO_WEBTEXT'] = df_charter['CMO_WEBTEXT'].apply(ast.literal_eval) # apply to whole column
 df_charter['CMO_WEBTEXT'] = df_charter['CMO_WEBTEXT'].replace(0, '') # now all nan are '' in both WEBTEXT columns
 
-# Optimized dict_count attempt for cases where entries in 'custom_dict' have long word lengths
-
-# precalculations
-dict_words = [entry.split() for entry in keywords] # list words for each dict entry
-dict_lengths = [len(x) for x in dict_words]
-first_words = [x[0] for x in dict_words] # first words of each entry in dict
-
-def dict_count1(text):
-    words_list = re.split('\W+', text) # list of words in text
-    # find indices where word in first_words matches word in words_list
-    mask = [[word == entry for word in words_list] for entry in first_words]
-    indices = np.transpose(np.nonzero(mask))
-    count = 0
-    for ind in indices:
-        if ind[1] <= (len(words_list) - dict_lengths[ind[0]]) and dict_words[ind[0]] == words_list[ind[1] : ind[1] + dict_lengths[ind[0]]]:
-            count+=1
-    return count
-
-# Repurposed Jaren Haber's dict_count and helper function in webparser_mp.py. Bug fixed on chunk building.
-max_entry_length = max([len(entry.split()) for entry in keywords]) # Get length (in words) of longest entry in combined dictionary
-
-def dict_count(text):
-
-    """Performs dictionary analysis, returning number of dictionary hits found.
-    Removes punctuation and stems the phrase being analyzed.
-    Compatible with multiple-word dictionary elements."""
-
-    counts = 0 # number of matches between text_list and custom_dict
-    splitted_phrase = re.split('\W+', text) # Remove punctuation with regex that keeps only letters and spaces
-
-    # Do dictionary analysis for word chunks of lengths max_entry_length down to 1
-    for length in range(1, max_entry_length + 1):
-        if len(splitted_phrase) < length:
-            continue # If text chunk is shorter than length of dict entries being matched, there are no matches.
-        for i in range(len(splitted_phrase) - length + 1):
-            entry = ' '.join(splitted_phrase[i:i+length]) # Builds chunk of 'length' words without ending space
-            if entry in keywords:
-                counts += 1
-
-    return counts
-
-# hybrid approach
-
-# separate keywords to be treated differently
-small_keywords = []
-large_keywords = []
-
-for entry in keywords:
-    small_keywords.append(entry) if len(entry.split()) < 3 else large_keywords.append(entry)
-
-large_words = [entry.split() for entry in large_keywords] # list words for each large dict entry
-large_lengths = [len(x) for x in large_words]
-large_first_words = [x[0] for x in large_words] # first words of each large entry in dict
-
-def dict_count2(text):
-
-    """Hybrid of dict_count and dict_count1. Uses dict_count1 approach to count matches for entries with > 2 words in keywords.
-    Uses dict_count approach for all other entries.
-    """
-
-    counts = 0 # number of matches between text_list and custom_dict
-    splitted_phrase = re.split('\W+', text) # Remove punctuation with regex that keeps only letters and spaces
-
-    # Do dictionary analysis for word chunks of lengths max_entry_length down to 1
-    for length in range(1, 3):
-        if len(splitted_phrase) < length:
-            continue # If text chunk is shorter than length of dict entries being matched, there are no matches.
-        for i in range(len(splitted_phrase) - length + 1):
-            entry = ' '.join(splitted_phrase[i:i+length]) # Builds chunk of 'length' words without ending space
-            if entry in keywords:
-                counts += keywords_values[entry]
-    mask = [[word == entry for word in splitted_phrase] for entry in large_first_words]
-    indices = np.transpose(np.nonzero(mask))
-    for ind in indices:
-        if ind[1] <= (len(splitted_phrase) - large_lengths[ind[0]]) and large_words[ind[0]] == splitted_phrase[ind[1] : ind[1] + large_lengths[ind[0]]]:
-            counts += keywords_values[large_keywords[ind[0]]]
-    return counts
-
-def filter_pages(school_pages, MIN_HITCOUNT = 1):
+batch_scoring = True # Set to 'True' to score every page of a column up front in one batch (sparse n-gram matrix times weights)
+
+def number_pages(column):
+    """Numbers the distinct pages of a WEBTEXT/CMO_WEBTEXT column, in order of first appearance.
+    Returns (dict of page key -> number, list of page texts by number, per row the tuple of its pages as (url, boo, depth, number)).
+    Rows with the same pages get equal tuples, which are cheap to hash and compare (see filter_column)."""
+    numbers = {}
+    texts = []
+    rows = []
+    for school_pages in column:
+        row = []
+        for p in school_pages:
+            key = page_key(p)
+            if key not in numbers:
+                numbers[key] = len(texts)
+                texts.append(p[3])
+            row.append((p[0], p[1], p[2], numbers[key]))
+        rows.append(tuple(row))
+    return numbers, texts, rows
+
+def score_column(column, numbered = None):
+    """Scores every distinct page of a WEBTEXT/CMO_WEBTEXT column at once. Returns dict of page key -> hit count.
+    numbered: number_pages(column), if already computed"""
+    numbers, texts, rows = numbered if numbered is not None else number_pages(column)
+    return dict(zip(numbers, scorer.score_batch(texts).tolist()))
+
+def filter_pages(school_pages, MIN_HITCOUNT = 1, hit_counts = None, MAX_NUMPAGES = None):
     """Returns the list of page text with hit count at least min hit count.
 
     Also filters out duplicate text.
     school_pages: entry of 'webtext' column
+    hit_counts: optional dict of page key -> hit count from score_column, used instead of scoring here
+    MAX_NUMPAGES: optional cap on pages passing the filter; the highest hit counts are kept, then the lowest depths
     """
     pages = set([Page(p) for p in school_pages])
     all_tuples = []
     filtered = []
+    filtered_hits = []
     max_hc = -1
     min_depth = 99999
-    for p in pages:
-        hit_count = dict_count2(p.text)
+    if hit_counts is not None:
+        page_scores = [hit_counts[p.key] for p in pages]
+    else:
+        page_scores = scorer.score_many([p.text for p in pages]) # pages shared between schools are scored once
+    for p, hit_count in zip(pages, page_scores):
         if hit_count >= MIN_HITCOUNT:
             filtered.append((p.url, p.boo, p.depth, p.text))
+            filtered_hits.append(hit_count)
         if max_hc < hit_count:
             max_hc = hit_count
         if min_depth > int(p.depth):
             min_depth = int(p.depth)
         all_tuples.append(((p.url, p.boo, p.depth, p.text),hit_count))
     if  filtered:
+        if (MAX_NUMPAGES is not None) and (len(filtered) > MAX_NUMPAGES):
+            best = sorted(range(len(filtered)), key = lambda j: (-filtered_hits[j], int(filtered[j][2])))[:MAX_NUMPAGES]
+            filtered = [filtered[j] for j in best]
         return (filtered, False)
     else:
         if max_hc == 0:
             return ([t[0] for t in all_tuples if int(t[0][2]) == min_depth], True)
         return ([t[0] for t in all_tuples if t[1] == max_hc], True)
-    # return [page for page in set(school_pages) if dict_count2(page[3])>=MIN_HITCOUNT] # maintains tuples but does not handle case where tuple is different but text is same
+    # return [page for page in set(school_pages) if scorer.score(page[3])>=MIN_HITCOUNT] # maintains tuples but does not handle case where tuple is different but text is same
+def column_hit_counts(type, cmo_numbered = None):
+    """Scores every distinct page the filter of given type reads, once. Returns dict of page key -> hit count.
+    cmo_numbered: number_pages() of the CMO_WEBTEXT column, if already computed"""
+    hit_counts = score_column(df_charter['CMO_WEBTEXT' if type == 'c' else 'WEBTEXT'].values, cmo_numbered if type == 'c' else None)
+    if type == 'a':
+        hit_counts.update(score_column(df_charter['CMO_WEBTEXT'].values, cmo_numbered))
+    return hit_counts
+
+def filter_column(type, MIN_HITCOUNT = 1.0, hit_counts = None, MAX_NUMPAGES = None, cmo_numbered = None):
+    """Filters every row for given type without changing df_charter. Returns (filtered page lists, flags), one per row.
+    Flags are the *_EMPTY booleans for types 'w' and 'c', and the WEBTEXT_METHOD codes for type 'a'.
+
+    hit_counts: optional dict of page key -> hit count (see column_hit_counts), so filters can share one scoring pass
+    MAX_NUMPAGES: optional cap on pages kept per school (see filter_pages)
+    cmo_numbered: number_pages() of the CMO_WEBTEXT column, if already computed (type 'a' numbers it otherwise)
+    """
+    filtered_pages = []
+    s = []
+    start = time.time()
+    cmo_results = {} # (CMO_NAME, numbered CMO pages) -> filter_pages result, computed once and reused by every school of the CMO
+    cmo_names = df_charter['CMO_NAME'].values if 'CMO_NAME' in df_charter.columns else [None] * len(df_charter)
+    cmo_rows = df_charter['CMO_WEBTEXT'].values
+    if type == 'a':
+        if cmo_numbered is None:
+            cmo_numbered = number_pages(cmo_rows)
+        cmo_lists = cmo_numbered[2] # each row's CMO pages by page number, so memo lookups never re-read page text
+    for i, row in enumerate(df_charter['CMO_WEBTEXT' if type == 'c' else 'WEBTEXT'].values):
+        result = filter_pages(row, MIN_HITCOUNT, hit_counts, MAX_NUMPAGES)
+        if type != 'a':
+            filtered_pages.append(result[0])
+            s.append(result[1])
+        elif result[1]:
+            cmo_key = (str(cmo_names[i]), cmo_lists[i])
+            if cmo_key not in cmo_results:
+                cmo_results[cmo_key] = filter_pages(cmo_rows[i],MIN_HITCOUNT, hit_counts, MAX_NUMPAGES)
+            result_cmo = cmo_results[cmo_key]
+            if result_cmo[1]:
+                filtered_pages.append(result[0])
+                s.append(2)
+            else:
+                filtered_pages.append(result_cmo[0])
+                s.append(1)
+        else:
+            filtered_pages.append(result[0])
+            s.append(0)
+        if i%1000 == 0:
+            end = time.time()
+            print('Time Elapsed:{:f}, Percent Complete:{:f}'.format(end - start,i*100/len(df_charter)))
+    return filtered_pages, s
+
 def run_filter(type, MIN_HITCOUNT = 1.0):
     """Runs filter of given type. Creates checkpoint file with column of filtered pages. Column name is of form 'CMO_FILTERED_TEXT#' for type 'c' and 'FILTERED_TEXT#' for type 'w' where # is min hit count.
 
@@ -147,64 +136,65 @@ def run_filter(type, MIN_HITCOUNT = 1.0):
     """
     if type == 'w':
         print('WEBTEXT Page filter start. Min hit count: {:f}'.format(MIN_HITCOUNT))
-        filtered_pages = []
-        s = []
-        start = time.time()
-        for i, row in enumerate(df_charter['WEBTEXT'].values):
-            result = filter_pages(row, MIN_HITCOUNT)
-            filtered_pages.append(result[0])
-            s.append(result[1])
-            if i%1000 == 0:
-                end = time.time()
-                print('Time Elapsed:{:f}, Percent Complete:{:f}'.format(end - start,i*100/len(df_charter)))
-        df_charter['WEBTEXT'] = pd.Series(filtered_pages, index=df_charter.index)
-        df_charter['WEBTEXT_EMPTY'] = pd.Series(s, index=df_charter.index)
-        ckpt_file_path = 'charters_full_2015{:s}{:d}_checkpoint1.pkl'.format(type,round(10*MIN_HITCOUNT))
-        df_charter.to_pickle(ckpt_file_path) # checkpoint file contains new column 'FILTERED_TEXT'
-        print('Completed text filtering. Saved checkpoint to ' + ckpt_file_path)
     elif type == 'c':
         print('CMO_WEBTEXT Page filter start. Min hit count: {:f}'.format(MIN_HITCOUNT))
-        filtered_pages = []
-        s = []
-        start = time.time()
-        for i, row in enumerate(df_charter['CMO_WEBTEXT'].values):
-            result = filter_pages(row, MIN_HITCOUNT)
-            filtered_pages.append(result[0])
-            s.append(result[1])
-            if i%1000 == 0:
-                end = time.time()
-                print('Time Elapsed:{:f}, Percent Complete:{:f}'.format(end - start,i*100/len(df_charter)))
+    else:
+        print('Complete Page filter start. Min hit score: {:f}'.format(MIN_HITCOUNT))
+    cmo_numbered = number_pages(df_charter['CMO_WEBTEXT'].values) if (type == 'a') or (type == 'c' and batch_scoring) else None # CMO pages numbered once, for scoring and the CMO memo
+    hit_counts = column_hit_counts(type, cmo_numbered) if batch_scoring else None
+    filtered_pages, s = filter_column(type, MIN_HITCOUNT, hit_counts, cmo_numbered = cmo_numbered)
+    if type == 'c':
         df_charter['CMO_WEBTEXT'] = pd.Series(filtered_pages, index=df_charter.index)
         df_charter['CMO_WEBTEXT_EMPTY'] = pd.Series(s, index=df_charter.index)
-        ckpt_file_path = 'charters_full_2015{:s}{:d}_checkpoint1.pkl'.format(type,round(10*MIN_HITCOUNT))
-        df_charter.to_pickle(ckpt_file_path) # checkpoint file contains new column 'FILTERED_TEXT'
-        print('Completed text filtering. Saved checkpoint to ' + ckpt_file_path)
-    elif type == 'a':
-        print('Complete Page filter start. Min hit score: {:f}'.format(MIN_HITCOUNT))
-        filtered_pages = []
-        s = []
-        start = time.time()
-        for i, row in enumerate(df_charter['WEBTEXT'].values):
-            result = filter_pages(row, MIN_HITCOUNT)
-            if result[1]:
-                result_cmo = filter_pages(df_charter.loc[df_charter.index[i], 'CMO_WEBTEXT'],MIN_HITCOUNT)
-                if result_cmo[1]:
-                    filtered_pages.append(result[0])
-                    s.append(2)
-                else:
-                    filtered_pages.append(result_cmo[0])
-                    s.append(1)
-            else:
-                filtered_pages.append(result[0])
-                s.append(0)
-            if i%1000 == 0:
-                end = time.time()
-                print('Time Elapsed:{:f}, Percent Complete:{:f}'.format(end - start,i*100/len(df_charter)))
+    else:
         df_charter['WEBTEXT'] = pd.Series(filtered_pages, index=df_charter.index)
-        df_charter['WEBTEXT_METHOD'] = pd.Series(s, index=df_charter.index) # 2 empty webtext, empty cmo_webtext, 1 empty_webtext, non empty cmo_webtext, 0 nonempty webtext
-        ckpt_file_path = 'charters_full_2015{:s}{:d}_checkpoint1.pkl'.format(type,round(MIN_HITCOUNT*10))
-        df_charter.to_pickle(ckpt_file_path) # checkpoint file contains modified 'WEBTEXT' column
-        print('Completed text filtering. Saved checkpoint to ' + ckpt_file_path)
+        if type == 'w':
+            df_charter['WEBTEXT_EMPTY'] = pd.Series(s, index=df_charter.index)
+        else:
+            df_charter['WEBTEXT_METHOD'] = pd.Series(s, index=df_charter.index) # 2 empty webtext, empty cmo_webtext, 1 empty_webtext, non empty cmo_webtext, 0 nonempty webtext
+    ckpt_file_path = 'charters_full_2015{:s}{:d}_checkpoint1.pkl'.format(type,round(10*MIN_HITCOUNT))
+    df_charter.to_pickle(ckpt_file_path) # checkpoint file contains the filtered column and its flag column
+    print('Completed text filtering. Saved checkpoint to ' + ckpt_file_path)
+
+def add_cmo_replaced(df):
+    """Adds 'REPLACED' (school's WEBTEXT replaced with CMO filtered pages) and 'CMO_REPLACED' (any school of the CMO was) to a type 'a' result."""
+    df['REPLACED'] = df['WEBTEXT_METHOD'] == 1 # replaced wtih CMO filtered pages
+    df_right = df.groupby('CMO_NAME')['REPLACED'].sum() > 0 # df to be merged to the right of df
+    df_right = df_right.reset_index()
+    df_right.rename(columns={"REPLACED": "CMO_REPLACED"},inplace=True)
+    return pd.merge(df, df_right, how = 'left', on = ['CMO_NAME'])
+
+def run_sweep(type, thresholds, max_numpages_list = [None]):
+    """Runs filter of given type for every MIN_HITCOUNT in thresholds and MAX_NUMPAGES in max_numpages_list, scoring each page once.
+    Saves the hit counts once, as '<column>_HITS' columns (one list per school, aligned with its pages), and for each
+    combination only the id columns plus the filtered column and its flags, instead of a full copy of df_charter.
+    """
+    print('Page filter sweep start. Type: {:s}, min hit counts: {}, max pages: {}'.format(type, thresholds, max_numpages_list))
+    cmo_numbered = number_pages(df_charter['CMO_WEBTEXT'].values) if type in ['a', 'c'] else None
+    hit_counts = column_hit_counts(type, cmo_numbered)
+    id_columns = [column for column in ['NCESSCH', 'CMO_NAME'] if column in df_charter.columns]
+    hits_df = df_charter[id_columns].copy()
+    for column in (['WEBTEXT', 'CMO_WEBTEXT'] if type == 'a' else ['CMO_WEBTEXT' if type == 'c' else 'WEBTEXT']):
+        hits_df[column + '_HITS'] = [[hit_counts[page_key(p)] for p in row] for row in df_charter[column].values]
+    hits_file_path = 'charters_full_2015{:s}_hits.pkl'.format(type)
+    hits_df.to_pickle(hits_file_path)
+    print('Saved page hit counts to ' + hits_file_path)
+
+    for MIN_HITCOUNT in thresholds:
+        for MAX_NUMPAGES in max_numpages_list:
+            filtered_pages, s = filter_column(type, MIN_HITCOUNT, hit_counts, MAX_NUMPAGES, cmo_numbered)
+            out_df = df_charter[id_columns].copy()
+            if type == 'c':
+                out_df['CMO_WEBTEXT'] = filtered_pages
+                out_df['CMO_WEBTEXT_EMPTY'] = s
+            else:
+                out_df['WEBTEXT'] = filtered_pages
+                out_df['WEBTEXT_EMPTY' if type == 'w' else 'WEBTEXT_METHOD'] = s
+            if type == 'a':
+                out_df = add_cmo_replaced(out_df)
+            sweep_file_path = 'charters_full_2015{:s}{:d}_{:s}_sweep.pkl'.format(type, round(10*MIN_HITCOUNT), str(MAX_NUMPAGES or 'all'))
+            out_df.to_pickle(sweep_file_path)
+            print('Saved filter with min hit count {:f}, max pages {:s} to {:s}'.format(MIN_HITCOUNT, str(MAX_NUMPAGES or 'all'), sweep_file_path))
 
 class Page:
     def __init__(self,p):
@@ -212,17 +202,18 @@ class Page:
         self.boo = p[1]
         self.depth = p[2]
         self.text = p[3]
+        self.key = page_key(p) # stored content hash, or the text itself
     def __repr__(self):
         return self.text
     def __eq__(self, other):
         if isinstance(other, Page):
-            return self.text == other.text
+            return self.key == other.key
         else:
             return False
     def __ne__(self, other):
         return (not self.__eq__(other))
     def __hash__(self):
-        return hash(self.__repr__())
+        return hash(self.key)
 
 # only checks filter type not min hit score. min hit score must be covertible to float
 if sys.argv[1] == 'c':
@@ -231,13 +222,13 @@ elif sys.argv[1] == 'w':
     run_filter('w', float(sys.argv[2]))
 elif sys.argv[1] == 'a':
     run_filter('a', float(sys.argv[2]))
-    df_charter['REPLACED'] = df_charter['WEBTEXT_METHOD'] == 1 # replaced wtih CMO filtered pages
-    df_right = df_charter.groupby('CMO_NAME')['REPLACED'].sum() > 0 # df to be merged to the right of df_charter
-    df_right = df_right.reset_index()
-    df_right.rename(columns={"REPLACED": "CMO_REPLACED"},inplace=True)
-    df_charter = pd.merge(df_charter, df_right, how = 'left', on = ['CMO_NAME'])
+    df_charter = add_cmo_replaced(df_charter)
     ckpt_file_path = 'charters_full_2015_{:d}.pkl'.format(round(float(sys.argv[2])*10))
     df_charter.to_pickle(ckpt_file_path) # checkpoint file contains new 'CMO_REPLACED','WEBTEXT_METHOD', and filtered 'WEBTEXT' columns
     print('Completed text filtering. Saved checkpoint to ' + ckpt_file_path)
+elif sys.argv[1] == 's':
+    # threshold sweep, e.g. s a 1,1.5,10 250,all : type, comma-separated min hit counts, optional comma-separated max pages per school ('all' for no cap)
+    max_numpages_list = [None if n == 'all' else int(n) for n in sys.argv[4].split(',')] if len(sys.argv) > 4 else [None]
+    run_sweep(sys.argv[2], [float(t) for t in sys.argv[3].split(',')], max_numpages_list)
 else:
-    print('Invalid type. Use c, w, or a for cmo_webtext, webtext, and complete filtering, respectively.')
+    print('Invalid type. Use c, w, or a for cmo_webtext, webtext, and complete filtering, respectively, or s for a threshold sweep.')
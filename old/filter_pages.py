@@ -8,7 +8,6 @@
 import csv
 import pandas as pd
 import os
-import re
 import string
 import collections
 
@@ -20,6 +19,9 @@ import nltk
 from nltk.corpus import stopwords
 import datetime
 import logging
+import sys
+sys.path.insert(0, "../filter_top_pages/")
+from keyword_scorer import KeywordScorer, top_k_by_group
 
 
 import string
@@ -59,77 +61,8 @@ original_df['WEBTEXT'] = new_ser
 # In[7]:
 
 
-keywords = ['values', 'academics', 'academic', 'skills', 'skill', 'purpose', 'purposes',
-                       'direction', 'mission', 'vision', 'visions', 'missions',
-                       'ideals', 'cause', 'causes', 'curriculum', 'curricular',
-                       'method', 'methods', 'pedagogy', 'pedagogical', 'pedagogies', 'approach', 'approaches', 'model', 'models', 'system', 'systems',
-                       'structure', 'structures', 'philosophy', 'philosophical', 'philosophies', 'beliefs', 'believe', 'belief',
-                       'principles', 'principle', 'creed', 'creeds', 'credo', 'moral', 'morals', 'morality', 'history', 'histories', 'our story',
-                       'the story', 'school story', 'background', 'backgrounds', 'founding', 'founded', 'foundation', 'foundations', 'foundational',
-                       'established','establishment', 'our school began', 'we began',
-                       'doors opened', 'school opened', 'about us', 'our school', 'who we are',
-                       'identity', 'identities', 'profile', 'highlights']
-
-
-# In[8]:
-
-
-keywords_values = {'values':2, 'academics':1, 'academic':1, 'skills':1, 'skill':1, 'purpose':2, 'purposes':2,
-                       'direction':1, 'mission':2, 'vision':2, 'visions':2, 'missions':2,
-                       'ideals':2, 'cause':1, 'causes':1, 'curriculum':2, 'curricular':2,
-                       'method':1, 'methods':1, 'pedagogy':2, 'pedagogical':1, 'pedagogies':1, 'approach':1, 'approaches':1, 'model':2, 'models':2, 'system':2, 'systems':2,
-                       'structure':1, 'structures':1, 'philosophy':2, 'philosophical':2, 'philosophies':2, 'beliefs':2, 'believe':2, 'belief':2,
-                       'principles':2, 'principle':2, 'creed':2, 'creeds':2, 'credo':2, 'moral':2, 'morals':2, 'morality':2, 'history':1, 'histories':1, 'our story':1,
-                       'the story':1, 'school story':1, 'background':1, 'backgrounds':1, 'founding':1, 'founded':1, 'foundation':1, 'foundations':1, 'foundational':1,
-                       'established':1,'establishment':1, 'our school began':1, 'we began':1,
-                       'doors opened':1, 'school opened':1, 'about us':2, 'our school':1, 'who we are':1,
-                       'identity':1, 'identities':1, 'profile':1, 'highlights':2}
-
-
-# In[9]:
-
-
-# Hybrid approach
-
-# Separate keywords to be treated differently
-small_keywords = []
-large_keywords = []
-
-for entry in keywords:
-    small_keywords.append(entry) if len(entry.split()) < 3 else large_keywords.append(entry)
-
-large_words = [entry.split() for entry in large_keywords] # list words for each large dict entry
-large_lengths = [len(x) for x in large_words]
-large_first_words = [x[0] for x in large_words] # first words of each large entry in dict
-
-
-# In[10]:
-
-
-def dict_count2(text):
-
-    """Hybrid of dict_count and dict_count1. 
-    
-    Uses dict_count1 approach to count matches for entries with > 2 words in keywords.
-    Uses dict_count approach for all other entries.
-    """
-
-    counts = 0 # hitscore
-    splitted_phrase = re.split('\W+|_', text.lower()) # Remove punctuation with regex that keeps only letters and spaces
-
-    for length in range(1, 3):
-        if len(splitted_phrase) < length:
-            continue # If text chunk is shorter than length of dict entries being matched, there are no matches.
-        for i in range(len(splitted_phrase) - length + 1):
-            entry = ' '.join(splitted_phrase[i:i+length]) # Builds chunk of 'length' words without ending space
-            if entry in keywords:
-                counts += keywords_values[entry]
-    mask = [[word == entry for word in splitted_phrase] for entry in large_first_words]
-    indices = np.transpose(np.nonzero(mask))
-    for ind in indices:
-        if ind[1] <= (len(splitted_phrase) - large_lengths[ind[0]]) and large_words[ind[0]] == splitted_phrase[ind[1] : ind[1] + large_lengths[ind[0]]]:
-            counts += keywords_values[large_keywords[ind[0]]]
-    return counts
+# shared, compiled page scorer (see filter_top_pages/keyword_scorer.py); this script lowercases and also splits on '_'
+scorer = KeywordScorer.from_file('../filter_top_pages/keywords_values.txt', lowercase=True, split_pattern=r'\W+|_')
 
 
 # In[11]:
@@ -148,58 +81,45 @@ def takeThird(elem):
 
 num = 0
 
-def filter_pages(li_tuples, MIN_HITCOUNT, MAX_NUMPAGES):
+def filter_column(column, MIN_HITCOUNT, MAX_NUMPAGES):
     """
-    Takes in a list of quadruples
-    string texts from a school. Most likely from the WEBTEXT column
-    For the row, the function returns the top 250 pages of the list who have the highest hitcount    
+    Takes in a column of lists of quadruples (one list per school, most likely the WEBTEXT column)
+    For each row, returns the top MAX_NUMPAGES page texts with hit count at least MIN_HITCOUNT,
+    prioritizing pages with the highest hit count and closest to 0th depth (hit count - depth), best first
+    Every page of the column is scored in one batch, and each school's top pages are picked with top_k_by_group
     """
     global num
     
-    #just keep track of the hit count
-    
-    #turn the list of quadruples into a list of just string texts  
-    
-    if len(li_tuples) == 0: #if taking in an emoty list, we return an empty list
-        return li_tuples
+    #turn each list of quadruples into (depth, text) pairs, all schools back to back; school i owns pages offsets[i]:offsets[i+1]
+    school_pages = [[(tup[2], tup[3]) for tup in li_tuples if len(tup) == 4] for li_tuples in column]
+    offsets = np.cumsum([0] + [len(pages) for pages in school_pages])
+    texts = [page for pages in school_pages for depth, page in pages]
+    depths = np.array([int(depth) for pages in school_pages for depth, page in pages], dtype=np.int64)
     
-    school_pages = []
-    
-    for tup in li_tuples:
-        if len(tup) == 4:
-            school_pages.append([tup[2], tup[3]])
-    
-    #depth = 0 #index, gow far in they are, depth in school_pages[1st part of tuple]
-    li_pairs = []
-    #index = 0
-    for depth, page in school_pages:
-        hit_count = dict_count2(page.lower())
-        if hit_count >= MIN_HITCOUNT:
-            li_pairs.append([page, hit_count - int(depth)]) #prioritize pages with highest hit count and closest to  0th depth
-        
-        #index+=1
-    
-    #sort the tuples/sublists by highest to lowest hit count
-    #take the top 250 , or less is len(school_pages) < 250
-
-    sorted_tuples = sorted(li_pairs,  reverse = True) #descending, prioritize pages with highest hit count and closest to  0th depth
-       
-    filtered_tuples = []
-    if len(sorted_tuples) < MAX_NUMPAGES:
-        filtered_tuples = sorted_tuples
-    else:
-        filtered_tuples = sorted_tuples[:MAX_NUMPAGES]
+    hit_counts = scorer.score_batch(texts)
+    passed = hit_counts >= MIN_HITCOUNT
+    priority = np.where(passed, hit_counts - depths, -np.inf) #pages below MIN_HITCOUNT rank last, and are dropped below
     
-    #get the page at the correpsonding index (tup[1]) from school_pages
-    final_pages = [tup[0] for tup in filtered_tuples] 
-    if final_pages is not None :
+    final_column = []
+    for li_tuples, best in zip(column, top_k_by_group(priority, offsets, MAX_NUMPAGES)):
+        if len(li_tuples) == 0: #if taking in an emoty list, we return an empty list
+            final_column.append(li_tuples)
+            continue
+        final_column.append([texts[i] for i in best if passed[i]])
         logging.info("row done : " + str(num))
-    else:
-        logging.info("row is None : " + str(num))
-        final_pages = []
-    num = num + 1
+        num = num + 1
+    
+    return final_column
+
+
+def filter_pages(li_tuples, MIN_HITCOUNT, MAX_NUMPAGES):
+    """
+    Takes in a list of quadruples
+    string texts from a school. Most likely from the WEBTEXT column
+    For the row, the function returns the top 250 pages of the list who have the highest hitcount    
+    """
     
-    return final_pages
+    return filter_column([li_tuples], MIN_HITCOUNT, MAX_NUMPAGES)[0]
     
 
 
@@ -257,7 +177,7 @@ def filter_pages(li_tuples, MIN_HITCOUNT, MAX_NUMPAGES):
 
 #new_webtext = middle(original_df)
 #new_webtext = original_df['WEBTEXT'].apply(filter_pages)
-original_df['WEBTEXT'] = original_df['WEBTEXT'].apply(lambda row_li: filter_pages(row_li, 1, 10))
+original_df['WEBTEXT'] = filter_column(original_df['WEBTEXT'].tolist(), 1, 10)
 filtered_df = original_df[['NCESSCH', 'WEBTEXT']]
 #filtered_df['WEBTEXT'] = new_webtext
 
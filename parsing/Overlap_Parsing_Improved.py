@@ -22,6 +22,10 @@ import logging
 
 from difflib import SequenceMatcher as SeqMatcher
 import numpy as np
+from page_store import pages_hash, page_key # page list content hashes, page dedup keys
+from page_arena import PageArena, build_arena, open_arena, arena_school # Shared memory-mapped page text for workers
+from shard_manifest import school_keys, load_manifest, pending_rows, write_shard # Resumable, sharded output
+from overlap_engines import intern_tokens, lsh_candidate_pairs, quick_ratio_matrix, quick_ratio_pairs, remove_shared_affixes, remove_template_lines # Faster alternatives to pairwise diffing
 
 # Import packages for multiprocessing
 import os # For navigation
@@ -31,6 +35,14 @@ folder_prefix = '/vol_b/data/'
 
 logging.basicConfig(filename="CMO_WEBTEXT_2.log", level=logging.INFO)
 
+overlap_engine = "pairwise" # "pairwise": diff pages against each other (create_first_cut); "template": drop lines shared by most of a school's pages, linear time; "affix": cut token prefixes/suffixes shared by several pages, one sort per school
+template_share = 0.5 # With the template engine, lines on more than this share of a school's pages are dropped
+affix_min_pages = 3 # With the affix engine, a header/footer must be shared by at least this many pages
+use_lsh = False # Set to 'True' to only diff pairs that also collide in MinHash/LSH (schools with > 20 pages): fewer pairs on big schools, but pairs LSH misses are no longer cut
+school_time_budget = 300 # Seconds create_first_cut may spend on one school before it falls back to the template engine
+school_char_budget = 20000000 # Schools with more text than this (characters, all pages) go straight to the template engine
+page_word_budget = 20000 # Likewise for schools with a page longer than this many words. The deadline is only checked between pairs, and one diff grows with the product of page lengths: at 20000 words a pair takes a few seconds at worst, at 40000 over 10
+
 # In[ ]:
 
 #is originally charters_full_2015_15_250.pkl for xxl vm , but is nowdata/charters_full_2015_250_new.pkl in large vm for testing purposes
@@ -41,86 +53,97 @@ next_df = pd.read_csv(folder_prefix + "nowdata/parsing/cmo_left.csv", sep="\t",
 # In[ ]:
 
 
-def create_first_cut(pages):
-    
+def cut_pair(pages, a, b, list_of_triples, final_cut_strings, best_keys):
+    #cuts the header (first matching block) and footer (2nd to last matching block) shared by pages a and b out of both
+    #list_of_triples are the matching blocks of pages a and b split by whitespace
+    #final_cut_strings[a] and [b] keep the shortest cut seen so far
 
-    final_cut_strings = pages.copy() #copy of pages
-   
-    for a in range(len(pages)):
-        
+    zeroth_triple = list_of_triples[0] #first triple, most likely in beginning, most likely a header
+    last_triple = list_of_triples[len(list_of_triples) - 2] #2nt to last triple is the footer indices
+
+    z_n = zeroth_triple[2] #j to j+n are the indices of the overlapping part
+    l_n = last_triple[2]
+
+    orig_string_a = pages[a]
+    split_li_a = orig_string_a[:zeroth_triple[0]] + " " + (orig_string_a[zeroth_triple[0] + z_n: last_triple[0]])+" " + (orig_string_a[last_triple[0] + l_n:]) 
+    #removes overlapping part in string a, removes header and footer
+    #keeps cut down part
+    cut_down_string_a = " ".join(split_li_a)
+
+
+    orig_string_b = pages[b]
+    split_li_b = orig_string_b[:zeroth_triple[1]] + " " + (orig_string_b[zeroth_triple[1] + z_n: last_triple[1]])+" " + (orig_string_b[last_triple[1] + l_n:]) 
+    #removes overlapping part in string a
+    cut_down_string_b = " ".join(split_li_b)
+
+    #a page keeps its shortest cut; among equally short cuts, the one from the pair that comes first in (a, b) order,
+    #so the result doesn't depend on the order pairs are compared in
+    order = a * len(pages) + b
+    if (len(cut_down_string_a), order) < best_keys[a]:
+        # this is our new low, cut down string, replace what's in fianal cut strings[a] with new version
+        final_cut_strings[a] = cut_down_string_a
+        best_keys[a] = (len(cut_down_string_a), order)
+
+    if (len(cut_down_string_b), order) < best_keys[b]:
+        final_cut_strings[b] = cut_down_string_b
+        best_keys[b] = (len(cut_down_string_b), order)
+
+
+def compared_pairs(pages, word_lists):
+    #yields the (a, b) pairs, a < b, that create_first_cut diffs, grouped by b
+
+    if (len(pages) <= 20):
+        #don't call get ratio
+        #go ahead and directly call get_matching_blocks
         for b in range(len(pages)):
-    
-            if a < b : #a and b are not the same
-            #we're iterating from a = 0 to len(pages) - 1, so we've already seen 0,1 compared and cut down strings when 0 is 
-            #compared to 1. Now we don't need to do anything to compare 1 to 0 and cut down again, cuz final_cut_strings[1]
-            #should already have cut down version of 1 when it was previously compared with 0
-
-                #get similarity ratio between a and b
-                list_a = pages[a].split() #splits string_a by whitespace
-                list_b = pages[b].split()
-
-                #already compared 1,2 , don't need to compare 2,1 - you already know it's added so you have indices of overlap
-                if (len(pages) <= 20):
-                    #don't call get ratio
-                    #go ahead and directly call get_matching_blocks
-                    
-                    list_of_triples = SeqMatcher(None, list_a, list_b).get_matching_blocks()
-                    zeroth_triple = list_of_triples[0] #first triple, most likely in beginning, most likely a header
-                    last_triple = list_of_triples[len(list_of_triples) - 2] #2nt to last triple is the footer indices
-
-                    z_n = zeroth_triple[2] #j to j+n are the indices of the overlapping part
-                    l_n = last_triple[2]
-
-                    orig_string_a = pages[a]
-                    split_li_a = orig_string_a[:zeroth_triple[0]] + " " + (orig_string_a[zeroth_triple[0] + z_n: last_triple[0]])+" " + (orig_string_a[last_triple[0] + l_n:]) 
-                    #removes overlapping part in string a, removes header and footer
-                    #keeps cut down part
-                    cut_down_string_a = " ".join(split_li_a)
-
-
-                    orig_string_b = pages[b]
-                    split_li_b = orig_string_b[:zeroth_triple[1]] + " " + (orig_string_b[zeroth_triple[1] + z_n: last_triple[1]])+" " + (orig_string_b[last_triple[1] + l_n:]) 
-                    #removes overlapping part in string a
-                    cut_down_string_b = " ".join(split_li_b)
-
-                    if (len(cut_down_string_a) < len(final_cut_strings[a])):
-                        # this is our new low, cut down string, replace what's in fianal cut strings[a] with new version
-                        final_cut_strings[a] = cut_down_string_a
-
-                    if len(cut_down_string_b) < len(final_cut_strings[b]):
-                        final_cut_strings[b] = cut_down_string_b
-                    
-                   
-                else: 
-                    quick_ratio = SeqMatcher(None, pages[a], pages[b]).quick_ratio()
-                
-                    if (quick_ratio >= 0.7) & (quick_ratio <  1.0):
-
-                        list_of_triples = SeqMatcher(None, list_a, list_b).get_matching_blocks()
-                        zeroth_triple = list_of_triples[0] #first triple, most likely in beginning, most likely a header
-                        last_triple = list_of_triples[len(list_of_triples) - 2] #2nt to last triple is the footer indices
-
-                        z_n = zeroth_triple[2] #j to j+n are the indices of the overlapping part
-                        l_n = last_triple[2]
-
-                        orig_string_a = pages[a]
-                        split_li_a = orig_string_a[:zeroth_triple[0]] +" " + (orig_string_a[zeroth_triple[0] + z_n: last_triple[0]]) + " " +(orig_string_a[last_triple[0] + l_n:]) 
-                        #removes overlapping part in string a, removes header and footer
-                        #keeps cut down part
-                        cut_down_string_a = " ".join(split_li_a)
-
-
-                        orig_string_b = pages[b]
-                        split_li_b = orig_string_b[:zeroth_triple[1]] +" " + (orig_string_b[zeroth_triple[1] + z_n: last_triple[1]])+ " " +(orig_string_b[last_triple[1] + l_n:]) 
-                        #removes overlapping part in string a
-                        cut_down_string_b = " ".join(split_li_b)
-
-                        if (len(cut_down_string_a) < len(final_cut_strings[a])):
-                            # this is our new low, cut down string, replace what's in fianal cut strings[a] with new version
-                            final_cut_strings[a] = cut_down_string_a
-
-                        if len(cut_down_string_b) < len(final_cut_strings[b]):
-                            final_cut_strings[b] = cut_down_string_b
+            for a in range(b): #a < b: we already know the overlap of (a, b), no need to compare (b, a) again
+                yield a, b
+        return
+
+    if use_lsh:
+        #only pairs whose MinHash signatures collide in an LSH band, so their number grows linearly with pages instead of n^2;
+        #they still have to pass the same quick_ratio gate, so LSH only ever drops pairs
+        candidates = sorted(lsh_candidate_pairs(word_lists), key=lambda pair: (pair[1], pair[0]))
+        quick_ratios = quick_ratio_pairs(pages, candidates)
+        for (a, b), ratio in zip(candidates, quick_ratios):
+            if (ratio >= 0.7) and (ratio < 1.0):
+                yield a, b
+        return
+
+    #same values as SeqMatcher(None, pages[a], pages[b]).quick_ratio(), for all pairs in one vectorized pass
+    quick_ratios = quick_ratio_matrix(pages)
+    similar = (quick_ratios >= 0.7) & (quick_ratios <  1.0)
+    for b in range(len(pages)):
+        for a in np.flatnonzero(similar[:b, b]):
+            yield int(a), b
+
+
+class SchoolTimeout(Exception):
+    pass
+
+
+def create_first_cut(pages, deadline=None):
+    #deadline: time.time() after which to give up on the school and raise SchoolTimeout
+
+    final_cut_strings = pages.copy() #copy of pages
+    best_keys = [(len(page), -1) for page in pages] #a cut only replaces the page if it's strictly shorter
+
+    #tokenize every page once: interned int ids compare and hash faster than strings, and the lists are reused by every pair
+    word_lists = [page.split() for page in pages] #splits each page by whitespace
+    token_lists = intern_tokens(word_lists)
+
+    #SequenceMatcher indexes its second sequence (b2j) in set_seq2, so pairs come grouped by b:
+    #page b is indexed once and diffed against each of its partners a with set_seq1
+    matcher = SeqMatcher(None)
+    current_b = None
+    for a, b in compared_pairs(pages, word_lists):
+        if (deadline is not None) and (time.time() > deadline):
+            raise SchoolTimeout()
+        if b != current_b:
+            matcher.set_seq2(token_lists[b])
+            current_b = b
+        matcher.set_seq1(token_lists[a])
+        cut_pair(pages, a, b, matcher.get_matching_blocks(), final_cut_strings, best_keys)
 
     #final_cut strings should be cut down 
     return final_cut_strings
@@ -129,78 +152,84 @@ def create_first_cut(pages):
 # In[ ]:
 
 
+header_punc = re.compile(r"[,.:;]") # First punctuation mark: where the first sentence-like line starts
+header_lines = re.compile(r"[\n\t]") # Lines/cells the header cut looks for a group of 7+ words in
+
+
+def second_header_cut(s):
+    #cuts the header left on one page: everything before the line holding the first punctuation mark,
+    #or before the first line of 7+ words, whichever comes first
+    
+    if(s is None):
+        s = ""
+
+    first_punc = header_punc.search(s)
+    punc_ind = first_punc.start() if first_punc else len(s)
+    start_punc = s.rfind("\n", 0, punc_ind) # largest index of \n that's less than index of first punctuation
+    if start_punc == -1:
+        start_punc = len(s)
+
+    #start of the first line with 7+ words, counted without the \n and \t separators before it
+    #(as the original character-by-character count did); the last line has no separator after it and is never counted
+    start_sev = len(s)-1 #make it huge by default; if there's no group of 7, then start punc will be the smallest
+    seen = 0
+    lines = header_lines.split(s)
+    for line in lines[:-1]:
+        if len(line.split(None, 6)) >= 7: # we hit 7 words or more, wipe everything before start index
+            start_sev = seen
+            break
+        seen += len(line)
+
+    #take smaller of the two indices, since we want to use the property which occurs first
+    if start_punc < start_sev:
+        #if start of sentence which ends in/contains puncuation occurs earlier, wipe eveything before that index
+        #only take that index +1 and on, start right after the new line
+        return s[start_punc+1:]
+    #if start of group of words that >= 7 occurs earlier than a sentence with punctuation, wipe eveything before that index
+    #only take that index and on, statr using that begining of the group of 7+ words
+    return s[start_sev:]
+
+
 def create_second_header_cut(first_header_cut):
+    #cuts the remaining header off a batch of pages (see second_header_cut)
     
-    super_final_strings = []
-    for s in first_header_cut:
-        s_new = ""
-        if(s is None):
-            s_new = ""
-        else:
-            s_new = s
-        use_punc = False
-        use_sev = False
-        punc = [",", ".", ":", ";"]
-        p_list = []
-        for p in punc:
-            if (s_new.find(p) != -1):
-                p_list.append(s_new.find(p))
-            else:
-                p_list.append(len(s_new))
-
-        punc_ind = min(p_list)
-
-        n_list = [index for index, k in enumerate(s_new) if k=='\n']
-        start_punc = len(s_new)
-        for i in n_list:
-            if(i < punc_ind):
-                start_punc = i # start_punc equals the largest index of \n that's less than index of first punctuation
-
-        start = 0
-        end = 0
-        total = ""
-        list_totals = []
-        st_en = []
-        for c in s_new:
-            if (c not in ['\n', '\t']):
-                total+=(c)
-                end+=1
-            else :
-                if(len(total.split()) >= 7): # we hit 7 words or more, wipe everything before start index
-                    #list_totals.append(total)
-                    st_en.append((start, end))
-
-                total= ""
-                start = end
-        start_sev = len(s_new)-1 #len(s)-1 #make it huge by default; if there's no group of 7, then start punc will be the smallest
-        if len(st_en) > 0:
-            start_sev = st_en[0][0] #index of first group of words that's >= 7 words; 0th tuple's start value
-
-
-        #take smaller of the two indices, since we want to use the property which occurs first
-        if start_punc < start_sev:
-            #if start of sentence which ends in/contains puncuation occurs earlier, wipe eveything before that index
-            #only take that index +1 and on, start right after the new line
-            new_string = s_new[start_punc+1:] 
-            super_final_strings.append(new_string)
+    return [second_header_cut(s) for s in first_header_cut]
 
-        else:
-            #if start of group of words that >= 7 occurs earlier than a sentence with punctuation, wipe eveything before that index
-            #only take that index and on, statr using that begining of the group of 7+ words
-            new_string = s_new[start_sev:] 
-            super_final_strings.append(new_string)
-        
-    return super_final_strings
+
+def ncessch_str(ncessch):
+    #NCESSCH read from CSV comes back as a float (e.g. 62223008323.0): log it as the integer id
+    return str(ncessch) if str(ncessch) == 'nan' else str(int(float(ncessch)))
+
+
+def budgeted_first_cut(pages, school_ids):
+    #create_first_cut within the school's size and time budgets; schools over budget get the linear-time template engine instead
+    #so a few pathological sites can't hold up the end of a run
+    
+    total_chars = sum(len(page) for page in pages if page)
+    longest_words = max((len(page.split()) for page in pages if page), default=0)
+    if total_chars > school_char_budget:
+        reason = "size: " + str(total_chars) + " characters"
+    elif longest_words > page_word_budget:
+        reason = "size: page of " + str(longest_words) + " words"
+    else:
+        start = time.time()
+        try:
+            return create_first_cut(pages, deadline = start + school_time_budget)
+        except SchoolTimeout:
+            reason = "time: over " + str(school_time_budget) + " seconds"
+    logging.warning("degraded to template engine (" + reason + ", " + str(len(pages)) + " pages): NCESSCH " + school_ids)
+    return remove_template_lines(pages, template_share)
 
 
 # In[ ]:
 
 k = 0
-def remove_string_overlaps(tuplist):
+def remove_string_overlaps(tuplist, school_ids=""):
+    #school_ids: NCESSCH of the school(s) these pages belong to, for the log
     global k
 
     unique_tuplist = []
-    seen_pages = set() # Initialize list of known pages for a school
+    seen_pages = set() # Initialize set of keys of known pages for a school
     unique_pages=[]
     tup_indices = []
 
@@ -211,20 +240,24 @@ def remove_string_overlaps(tuplist):
         return new_list
     else :
         
-        for tup in tuplist:
-            if (tup is not None) and (len(tup) > 3):
-                seen_pages.add(tup[3])
-
         for i in range(len(tuplist)):
-            if (len(tuplist[i]) > 3) and (tuplist[i][3] in seen_pages) and (tuplist[i][3]  not in unique_pages):
-                unique_tuplist.append(tuplist[i])
-                unique_pages.append(tuplist[i][3])
-                tup_indices.append(i)
-                #print("unique page : " + str(i))
+            if (tuplist[i] is not None) and (len(tuplist[i]) > 3):
+                key = page_key(tuplist[i]) # content hash stored in the arena, or the text itself
+                if key not in seen_pages:
+                    seen_pages.add(key)
+                    unique_tuplist.append(tuplist[i])
+                    unique_pages.append(tuplist[i][3])
+                    tup_indices.append(i)
+                    #print("unique page : " + str(i))
 
         #now compare all pages with each other 
         #final cut strings already should have supposed "headers" and "footers" removed
-        final_cut_strings = create_first_cut(unique_pages)
+        if overlap_engine == "template":
+            final_cut_strings = remove_template_lines(unique_pages, template_share)
+        elif overlap_engine == "affix":
+            final_cut_strings = remove_shared_affixes(unique_pages, affix_min_pages)
+        else:
+            final_cut_strings = budgeted_first_cut(unique_pages, school_ids)
 
         #first removal of headers in final_cut_strings currently, but now we want to cut down headers more
         #take out text before the first sentence or text before the first group of 7+ words  
@@ -246,11 +279,11 @@ def remove_string_overlaps(tuplist):
 #apply remove_string_overlaps on each school, aka on each row of new_data
 #since pages of a school will likely be similar to the other pages within that school own
 
-def parse_df(old_list):
+def parse_df(old_list, school_ids=""):
     
 #     print("INSIDE PARSE_DF, list is : " + old_list)
     
-    new_list = remove_string_overlaps(old_list)
+    new_list = remove_string_overlaps(old_list, school_ids)
     return new_list
 
 
@@ -263,14 +296,14 @@ def parse_df(old_list):
 next_df['CMO_WEBTEXT'] = next_df['CMO_WEBTEXT'].fillna("[]")
 next_df['CMO_WEBTEXT'] = next_df['CMO_WEBTEXT'].apply(ast.literal_eval) 
 
-# lookup = pd.read_csv(folder_prefix + "nowdata/parsing/lookup.csv", sep="\t", low_memory=False, encoding="utf-8") #fix lookup csv
-
-# unseen_df = lookup[lookup['OVERLAPS_REMOVED'] == 0]
-# unseen_list = list(set(unseen_df['NCESSCH'].tolist()))
-
-# new_data = full_250_df[full_250_df['NCESSCH'].isin(unseen_list)]
+#schools finished by earlier (interrupted) runs are listed in the output manifest and skipped, no lookup table needed
+output_dir = folder_prefix + "nowdata/parsing/CMO_WEBTEXT_2_shards" # Numbered result shards plus _manifest.json
+shard_size = 500 # Schools per result shard (a shard is cut once a finished chunk fills it); only schools not yet in a shard are lost if a run dies
 
-arr_of_dfs = np.array_split(next_df, next_df.shape[0]) #gives you a list of dataframes, each dataframe has 1 rows
+school_keys_list = school_keys(next_df)
+manifest = load_manifest(output_dir)
+pending = pending_rows(school_keys_list, manifest) # positions in next_df still to parse
+logging.info("resuming with " + str(len(pending)) + " of " + str(next_df.shape[0]) + " schools left, " + str(len(manifest["shards"])) + " shards done")
 
 
 # In[ ]:
@@ -280,7 +313,7 @@ def chunk_assign(df_chunk): #Jaren chunk by chunk
     
 #     print("TYPE of DF CHUNK in chunk_assign : " + str(type(df_chunk)))
     
-    df_chunk['CMO_WEBTEXT'] = df_chunk['CMO_WEBTEXT'].apply(parse_df)
+    df_chunk['CMO_WEBTEXT'] = [parse_df(tuplist, ncessch_str(ncessch)) for tuplist, ncessch in zip(df_chunk['CMO_WEBTEXT'], df_chunk['NCESSCH'])]
     
     #print("TYPE of DF_CHUNK : " + str(type(df_chunk)))
    
@@ -292,51 +325,108 @@ def chunk_assign(df_chunk): #Jaren chunk by chunk
 # In[ ]:
 
 
-global num
-num = 0
-numcpus = len(os.sched_getaffinity(0)) # Detect and assign number of available CPUs
-#p = mp.Pool(numcpus)
+def parse_arena_school(row):
+    """Removes overlaps for school number row of the shared page arena.
+    Only the row index is pickled to the worker; the page text is read from the memory-mapped arena."""
 
+    #schools_of is set up before the pool starts, so forked workers have it
+    school_ids = ", ".join(ncessch_str(next_df['NCESSCH'].iloc[pending[k]]) for k in schools_of[row])
+    return parse_df(arena_school(row), school_ids)
 
-# indices_arr = np.arange(len(arr_of_dfs))
-# ind_subarrays = np.array_split(indices_arr, ten_count) #np.array_split gives you a list
 
-for chunk in arr_of_dfs:
-#     print("TYPE of arr_of_dfs[0] : " + str(type(arr_of_dfs[0])))
-    with mp.Pool(processes = numcpus) as p:
-        chunk_arr = np.array_split(chunk, chunk.shape[0]) #split chunk into an array of dfs,
-        #p.map takes in an iterable and applies function on each element of array
-        #now chunk_arr is an array of 10 dataframes (each of which was a row previously in chunk)
-        list_of_dfs = p.map(chunk_assign, chunk_arr)
-        temp_df = pd.concat(list_of_dfs, ignore_index = True) 
-    #     for i in temp_df:
-    #         print("TYPE of i in TEMP_DF : " + str(type(i)))
-    #     print("TYPE of TEMP_DF : " + str(type(temp_df)))
-        num +=1
-        if  num == 1: # Save first slice to new file (overwriting if needed)
-            #print("NUM  is 1 : " + str(num))
-            logging.info("df chunk # " + str(num))
-            temp_df.to_csv(folder_prefix + "nowdata/parsing/CMO_WEBTEXT_2.csv", mode="w", index=False, header=temp_df.columns.values, sep="\t", encoding="utf-8")
+def parse_arena_chunk(rows):
+    """Removes overlaps for several arena schools in one task. Returns a list of (row, new_list)."""
 
+    return [(row, parse_arena_school(row)) for row in rows]
 
-        else:
-            #print("NUM is actually : " + str(num))
-            logging.info("df chunk # " + str(num))
-            temp_df.to_csv(folder_prefix + "nowdata/parsing/CMO_WEBTEXT_2.csv", mode="a", index=False, header=False, sep="\t", encoding="utf-8")
 
+def cost_chunks(costs, numchunks):
+    """Groups school rows into chunks of about equal estimated cost (about numchunks in total), most expensive first.
+    The biggest schools get a chunk of their own and are started first, so they don't straggle at the end;
+    the many small schools are batched so they don't cost a task round trip each."""
 
+    order = np.argsort(-costs, kind="stable")
+    target = costs.sum() / numchunks
+    chunks, chunk, chunk_cost = [], [], 0.0
+    for row in order:
+        chunk.append(int(row))
+        chunk_cost += costs[row]
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk, chunk_cost = [], 0.0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def save_shard(rows, new_lists):
+    """Saves parsed schools (positions in next_df and their new page lists) as the next shard, in next_df order, and marks them done."""
+
+    order = sorted(range(len(rows)), key=rows.__getitem__)
+    rows = [rows[i] for i in order]
+    temp_df = next_df.iloc[rows].copy()
+    temp_df['CMO_WEBTEXT'] = [new_lists[i] for i in order]
+    write_shard(temp_df, output_dir, manifest, [school_keys_list[row] for row in rows])
+    logging.info("shard # " + str(len(manifest["shards"])) + " saved, " + str(len(manifest["done"])) + " schools done")
+
+
+# In[ ]:
+
+
+numcpus = len(os.sched_getaffinity(0)) # Detect and assign number of available CPUs
+#p = mp.Pool(numcpus)
+
+use_arena = True # Set to 'True' to give workers school indexes into a memory-mapped page arena instead of pickled one-row DataFrames
+arena_path = folder_prefix + "nowdata/parsing/cmo_arena" # Where the arena for next_df['CMO_WEBTEXT'] is written
+chunks_per_cpu = 16 # Schools are batched into about this many cost-balanced tasks per CPU
+use_cmo_cache = True # Set to 'True' to parse each distinct CMO page list once and reuse the result for every school sharing it
+
+if use_arena:
+    #schools of the same CMO mostly carry identical CMO_WEBTEXT: put each distinct page list in the arena once
+    #(keyed by its content hash) and hand its result to every school that has it
+    arena_rows = [] # next_df row of arena school j
+    arena_school_of = [] # arena school holding the pages of pending[k]
+    arena_index = {} # page list hash -> arena school
+    for row in pending:
+        key = pages_hash(next_df['CMO_WEBTEXT'].iloc[row]) if use_cmo_cache else row
+        if key not in arena_index:
+            arena_index[key] = len(arena_rows)
+            arena_rows.append(row)
+        arena_school_of.append(arena_index[key])
+    logging.info("parsing " + str(len(arena_rows)) + " distinct page lists for " + str(len(pending)) + " schools")
+    schools_of = [[] for j in arena_rows] # positions in pending of the schools that get arena school j's result
+    for k, j in enumerate(arena_school_of):
+        schools_of[j].append(k)
+
+    build_arena(arena_path, ((row, next_df['CMO_WEBTEXT'].iloc[row]) for row in arena_rows))
+    school_pages, school_bytes = PageArena(arena_path).school_sizes()
+    school_costs = school_pages.astype(float)**2 * school_bytes # pairwise diffing grows with pages^2 x text length
+    shard_rows, shard_lists = [], []
+    with mp.Pool(processes = numcpus, initializer = open_arena, initargs = (arena_path,)) as p:
+        #one pool for the whole run; schools go into shards as their chunks complete, so only the unsaved ones are held here
+        #(shards are in completion order: load_shards(output_dir, keys = school_keys_list) gives next_df order back)
+        for results in p.imap_unordered(parse_arena_chunk, cost_chunks(school_costs, numcpus * chunks_per_cpu)):
+            for j, new_list in results:
+                for k in schools_of[j]:
+                    shard_rows.append(pending[k])
+                    shard_lists.append(new_list)
+            if len(shard_rows) >= shard_size:
+                save_shard(shard_rows, shard_lists)
+                shard_rows, shard_lists = [], []
+    if len(shard_rows) > 0:
+        save_shard(shard_rows, shard_lists)
+
+else:
+    with mp.Pool(processes = numcpus) as p: # one pool for the whole run, not one per row
+        for start in range(0, len(pending), shard_size):
+            chunk = next_df.iloc[pending[start:start + shard_size]]
+            chunk_arr = np.array_split(chunk, chunk.shape[0]) #split chunk into an array of dfs,
+            #p.map takes in an iterable and applies function on each element of array
+            #now chunk_arr is an array of one-row dataframes (each of which was a row previously in chunk)
+            list_of_dfs = p.map(chunk_assign, chunk_arr)
+            temp_df = pd.concat(list_of_dfs, ignore_index = True) 
+            save_shard(pending[start:start + shard_size], temp_df['CMO_WEBTEXT'].tolist())
 
-# for sub_array in ind_subarrays:
-#     arr_dfs_chunk = arr_of_dfs[sub_array[0]: sub_array[len(sub_array) -1] +1]
-#     temp_df = p.map(chunk_assign, arr_dfs_chunk)
-    
-#     if  num == 1: # Save first slice to new file (overwriting if needed)
-#         temp_df.to_csv(folder_prefix + "nowdata/parsing/parsed_df_7.csv", mode="w", index=False, header=temp_df.columns.values, sep="\t", encoding="utf-8")
-        
-#     else:
-#         temp_df.to_csv(folder_prefix + "nowdata/parsing/parsed_df_7.csv", mode="a", index=False, header=False, sep="\t", encoding="utf-8")
 
-    
 
-p.close()
 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Content-addressed, dictionary-compressed storage for page bodies
+# Project title: Charter school identities
+#
+# School and CMO sites repeat the same headers, menus and footers on every page, and district-hosted pages
+# (e.g. k12northstar.org) show up under several schools. Bodies are therefore stored once per distinct text,
+# keyed by the 64-bit content hash from page_store.page_hash(), and compressed with a zstd dictionary trained
+# on a sample of our own pages so the shared boilerplate costs a few bytes per page.
+#
+# Storage is a single SQLite file:
+#     blobs (hash INTEGER PRIMARY KEY, size INTEGER, data BLOB)    one row per distinct page text
+#     meta (key TEXT PRIMARY KEY, value BLOB)                      the trained dictionary
+# The primary key gives random access by hash without reading anything else.
+#
+# Requires the zstandard package (pip install zstandard), on top of the pandas/pyarrow the page store needs.
+#
+# Usage:
+#     blobs = BlobStore("../../nowdata/page_blobs.db")
+#     blobs.train(sample_texts)         # once, before the first put
+#     hashes = blobs.put_many(texts)
+#     texts = blobs.get_many(hashes)
+
+
+import sqlite3 # For the blob file
+import zstandard as zstd # For dictionary compression
+from page_store import page_hash # 64-bit page content hashes
+
+
+class BlobStore:
+    """Stores each distinct page text once, compressed with a shared zstd dictionary.
+    Open one BlobStore per process; SQLite connections must not be shared across a fork."""
+
+    def __init__(self, blob_path, level=10):
+        self.conn = sqlite3.connect(blob_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL") # Lets ingest workers read while another writes
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash INTEGER PRIMARY KEY, size INTEGER, data BLOB)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+        self.conn.commit()
+        self.level = level
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'dictionary'").fetchone()
+        self.set_dictionary(row[0] if row else None)
+
+    def set_dictionary(self, dict_bytes):
+        """Builds compressor/decompressor for dict_bytes (or plain zstd if None)."""
+        self.dictionary = zstd.ZstdCompressionDict(dict_bytes) if dict_bytes else None
+        self.compressor = zstd.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+        self.decompressor = zstd.ZstdDecompressor(dict_data=self.dictionary)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def train(self, texts, dict_size=112640):
+        """Trains the shared dictionary on a sample of page texts (a few thousand pages is plenty) and saves it.
+        Must run before the first put: blobs already stored can only be read with the dictionary they were written with."""
+        if len(self) > 0:
+            raise ValueError("BlobStore already holds blobs; train the dictionary on an empty store")
+        dictionary = zstd.train_dictionary(dict_size, [text.encode("utf-8", "surrogatepass") for text in texts if text])
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('dictionary', ?)", (dictionary.as_bytes(),))
+        self.conn.commit()
+        self.set_dictionary(dictionary.as_bytes())
+
+    def trained(self):
+        return self.dictionary is not None
+
+    def put_many(self, texts, hashes=None):
+        """Stores texts not already present and returns their content hashes.
+        Pass precomputed hashes (e.g. the page store's 'hash' column) to skip re-hashing."""
+        if hashes is None:
+            hashes = [page_hash(text) for text in texts]
+        present = set(self.contains(hashes))
+        new_rows, queued = [], set()
+        for text, h in zip(texts, hashes):
+            if h in present or h in queued:
+                continue # Identical page already stored, under this school or another
+            encoded = (text or "").encode("utf-8", "surrogatepass")
+            new_rows.append((h, len(encoded), self.compressor.compress(encoded)))
+            queued.add(h)
+        self.conn.executemany("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)", new_rows)
+        self.conn.commit()
+        return list(hashes)
+
+    def put(self, text):
+        return self.put_many([text])[0]
+
+    def contains(self, hashes):
+        """Returns the subset of hashes already stored."""
+        found = []
+        hashes = list(set(hashes))
+        for i in range(0, len(hashes), 500): # Stay under SQLite's bound-parameter limit
+            batch = hashes[i:i + 500]
+            found.extend(row[0] for row in self.conn.execute(
+                "SELECT hash FROM blobs WHERE hash IN (" + ",".join(["?"] * len(batch)) + ")", batch))
+        return found
+
+    def get_many(self, hashes):
+        """Returns page texts for hashes, in the same order. Raises KeyError for a hash that was never stored."""
+        hashes = list(hashes)
+        texts = {}
+        unique = list(set(hashes))
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            for h, size, data in self.conn.execute(
+                    "SELECT hash, size, data FROM blobs WHERE hash IN (" + ",".join(["?"] * len(batch)) + ")", batch):
+                texts[h] = "" if size == 0 else str(self.decompressor.decompress(data), "utf-8", "surrogatepass")
+        return [texts[h] for h in hashes]
+
+    def get(self, h):
+        return self.get_many([h])[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Batch visible-text extraction from raw HTML page bodies
+# Project title: Charter school identities
+#
+# Pipeline version of tag_visible()/text_from_html() from "Visible Text Filtering.ipynb".
+# Reads the raw bodies that preprocess.py ingested from the crawl dump into the page store, keeps only text a
+# visitor would see (no script, style, head, title, meta or comments), and writes each school to a second page store.
+# Parsing uses lxml, which is many times faster than BeautifulSoup's html.parser; the notebook's BeautifulSoup
+# version is kept as a fallback for pages lxml can't handle. Schools are spread over a process pool, and each
+# page gets a wall-clock timeout so one pathological page can't stall a worker.
+
+
+import os # For navigation
+import signal # For per-page timeouts
+import logging
+import multiprocessing as mp # For spreading schools over CPUs
+
+import lxml.html # Fast HTML parsing
+from lxml import etree
+from bs4 import BeautifulSoup # Slow but forgiving fallback parser
+from bs4.element import Comment
+
+from page_store import as_bool, list_schools, load_school_df, write_school
+from blob_store import BlobStore
+
+
+source_store = "../../webtext_store" # Page store with raw HTML bodies, written by preprocess.py
+visible_store = "../../webtext_visible_store" # Page store to write visible text to
+blob_path = None # Set if source_store was written with a blob store (bodies are then looked up by hash)
+page_timeout = 10 # Seconds allowed per page before it is given up on (and left empty)
+numcpus = len(os.sched_getaffinity(0)) # Detect and assign number of available CPUs
+
+logging.basicConfig(filename="extract_visible_text.log", level=logging.INFO)
+
+invisible_tags = {'style', 'script', 'head', 'title', 'meta', '[document]'}
+
+
+def tag_visible(element):
+    if element.parent.name in invisible_tags:
+        return False
+    if isinstance(element, Comment):
+        return False
+    return True
+
+
+def text_from_html(body):
+    """BeautifulSoup version from "Visible Text Filtering.ipynb", used when lxml fails on a page."""
+    soup = BeautifulSoup(body, 'html.parser')
+    texts = soup.findAll(text=True)
+    visible_texts = filter(tag_visible, texts)
+    return u" ".join(t.strip() for t in visible_texts)
+
+
+def fast_text_from_html(body):
+    """lxml version of text_from_html(): every visible text node, stripped and joined by spaces, in document order.
+    Matches text_from_html() on regular HTML documents. An element's .text comes right after its start tag and
+    belongs to the element itself; its .tail comes after its end tag and belongs to its parent."""
+
+    if isinstance(body, str):
+        body = body.encode('utf-8', 'surrogatepass') # lxml refuses str input that carries an encoding declaration
+    root = lxml.html.fromstring(body, parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    texts = []
+    stack = [(root, False)] # Explicit stack instead of recursion: some crawled pages nest thousands of levels deep
+    while stack:
+        element, ended = stack.pop()
+        if ended:
+            parent = element.getparent()
+            if element.tail is not None and parent is not None and parent.tag not in invisible_tags:
+                texts.append(element.tail)
+            continue
+        # Comments and processing instructions have non-str tags; their own text is skipped but their tail is kept
+        if isinstance(element.tag, str) and element.tag not in invisible_tags and element.text is not None:
+            texts.append(element.text)
+        stack.append((element, True))
+        stack.extend((child, False) for child in reversed(element))
+    return u" ".join(t.strip() for t in texts)
+
+
+class PageTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise PageTimeout()
+
+
+def visible_text(body):
+    """Extracts visible text from one body within page_timeout seconds. Returns (text, status)."""
+
+    if not body:
+        return "", "empty"
+    signal.setitimer(signal.ITIMER_REAL, page_timeout)
+    try:
+        try:
+            return fast_text_from_html(body), "ok"
+        except (etree.ParserError, ValueError):
+            return text_from_html(body), "fallback"
+    except PageTimeout:
+        return "", "timeout"
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def extract_school(key):
+    """Worker: loads one school's raw pages (partition key), extracts visible text from each non-PDF page, and writes
+    the school to visible_store under the same key. Returns (key, counts of page statuses)."""
+
+    blobs = BlobStore(blob_path) if blob_path else None # Opened per worker: SQLite connections can't cross a fork
+    school_df = load_school_df(source_store, key, blobs=blobs)
+    crawl_id = school_df["crawl_id"].iloc[0] if len(school_df) > 0 else -1
+    counts = {}
+    new_pages = []
+    for url, is_pdf, depth, body in zip(school_df["url"], school_df["is_pdf"], school_df["depth"], school_df["text"]):
+        if as_bool(is_pdf): # Stored as the string 'True'/'False'
+            text, status = body, "pdf" # No HTML to strip
+        else:
+            text, status = visible_text(body)
+        if status == "timeout":
+            logging.info("Timed out on " + str(url) + " (school " + key + ")")
+        counts[status] = counts.get(status, 0) + 1
+        new_pages.append((url, is_pdf, depth, text))
+    write_school(visible_store, key, crawl_id, new_pages)
+    if blobs is not None:
+        blobs.close()
+    return key, counts
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGALRM, raise_timeout) # Inherited by forked workers
+
+    key_list = list_schools(source_store)
+    print("Extracting visible text for " + str(len(key_list)) + " schools on " + str(numcpus) + " CPUs")
+    totals = {}
+    with mp.Pool(processes=numcpus) as p:
+        for i, (key, counts) in enumerate(p.imap_unordered(extract_school, key_list, chunksize=4)):
+            for status in counts:
+                totals[status] = totals.get(status, 0) + counts[status]
+            if i % 1000 == 0:
+                print("Schools done: " + str(i) + ", pages by status: " + str(totals))
+    print("Finished visible text extraction to " + visible_store + ", pages by status: " + str(totals))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Faster building blocks for header/footer (overlap) removal
+# Project title: Charter school identities
+#
+# Overlap_Parsing_Improved.py runs as a script on import, so the algorithms it can switch between live here,
+# where workers and other stages can import them.
+
+
+import re # For splitting pages into lines
+import zlib # For stable 32-bit shingle hashes
+import numpy as np # For vectorized signatures
+
+
+# ## Interned page tokens
+
+def intern_pages(word_lists):
+    """Maps each page's words to int32 token ids, shared by all pages of one school (equal words, equal ids).
+    Input: one list of words per page. Output: one numpy int32 array per page.
+    Ids are only meaningful within the school they were interned for."""
+
+    vocab = {}
+    return [np.fromiter((vocab.setdefault(word, len(vocab)) for word in words), dtype=np.int32, count=len(words))
+            for words in word_lists]
+
+
+def intern_tokens(word_lists):
+    """Like intern_pages(), but returns plain lists of Python ints, ready for SequenceMatcher.
+    Skips the numpy round trip (SequenceMatcher hashes Python ints anyway, so int32 arrays only cost a tolist())."""
+
+    vocab = {}
+    return [[vocab.setdefault(word, len(vocab)) for word in words] for words in word_lists]
+
+
+# ## All-pairs quick_ratio for create_first_cut
+
+ratio_block_cells = 1 << 24 # Cap on page-pair x character cells held in memory at once by quick_ratio_matrix/quick_ratio_pairs
+
+
+def char_histograms(pages):
+    """Returns an (n pages x distinct characters) int32 matrix of character counts."""
+
+    codes = [np.frombuffer((page or "").encode("utf-32-le", "surrogatepass"), dtype=np.uint32) for page in pages]
+    lengths = np.array([len(c) for c in codes], dtype=np.int64)
+    if lengths.sum() == 0:
+        return np.zeros((len(pages), 1), dtype=np.int32)
+    chars, char_ids = np.unique(np.concatenate(codes), return_inverse=True)
+    page_ids = np.repeat(np.arange(len(pages)), lengths)
+    counts = np.bincount(page_ids * len(chars) + char_ids, minlength=len(pages) * len(chars))
+    return counts.reshape(len(pages), len(chars)).astype(np.int32)
+
+
+def quick_ratio_matrix(pages):
+    """Returns an n x n float matrix whose [a, b] entry equals SequenceMatcher(None, pages[a], pages[b]).quick_ratio().
+    quick_ratio is 2 * (characters the two pages have in common, with multiplicity) / (total length),
+    i.e. the min-sum of their character histograms, so every pair is computed at once with numpy
+    (in blocks of rows, to bound memory)."""
+
+    hist = char_histograms(pages)
+    n = len(pages)
+    lengths = hist.sum(axis=1, dtype=np.int64)
+    matches = np.empty((n, n), dtype=np.int64)
+    block = max(1, ratio_block_cells // max(1, n * hist.shape[1]))
+    for start in range(0, n, block):
+        rows = hist[start:start + block]
+        matches[start:start + block] = np.minimum(rows[:, None, :], hist[None, :, :]).sum(axis=2, dtype=np.int64)
+    totals = lengths[:, None] + lengths[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where(totals > 0, 2.0 * matches / totals, 1.0) # SequenceMatcher calls two empty strings identical
+    return ratios
+
+
+def quick_ratio_pairs(pages, pairs):
+    """Returns quick_ratio_matrix(pages)[a, b] for each (a, b) in pairs only, e.g. the LSH candidates,
+    so the cost grows with the number of pairs instead of n^2."""
+
+    hist = char_histograms(pages)
+    lengths = hist.sum(axis=1, dtype=np.int64)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    matches = np.empty(len(pairs), dtype=np.int64)
+    block = max(1, ratio_block_cells // hist.shape[1])
+    for start in range(0, len(pairs), block):
+        a, b = pairs[start:start + block, 0], pairs[start:start + block, 1]
+        matches[start:start + block] = np.minimum(hist[a], hist[b]).sum(axis=1, dtype=np.int64)
+    totals = lengths[pairs[:, 0]] + lengths[pairs[:, 1]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(totals > 0, 2.0 * matches / totals, 1.0)
+
+
+# ## MinHash / LSH candidate pairs for create_first_cut
+
+minhash_perms = 64 # Number of hash functions in each MinHash signature
+minhash_bands = 32 # LSH bands; rows per band = minhash_perms // minhash_bands. 32 x 2 flags pairs with word-shingle Jaccard of roughly 0.2 and up
+shingle_size = 3 # Words per shingle
+bucket_window = 3 # In an LSH bucket, each page is paired with at most this many following members
+mersenne_prime = (1 << 61) - 1
+
+rng = np.random.RandomState(0) # Fixed seed, so candidate pairs are reproducible between runs
+perm_a = rng.randint(1, 1 << 31, size=minhash_perms).astype(np.uint64)
+perm_b = rng.randint(0, 1 << 31, size=minhash_perms).astype(np.uint64)
+
+
+def shingle_hashes(words):
+    """Returns the set of 32-bit hashes of the page's shingle_size-word shingles (whole page if shorter)."""
+
+    if len(words) < shingle_size:
+        return {zlib.crc32(" ".join(words).encode("utf-8", "surrogatepass"))}
+    return {zlib.crc32(" ".join(words[i:i + shingle_size]).encode("utf-8", "surrogatepass"))
+            for i in range(len(words) - shingle_size + 1)}
+
+
+def minhash_signature(words):
+    """Returns the MinHash signature (minhash_perms uint64 values) of a page's word shingles."""
+
+    hashes = np.fromiter(shingle_hashes(words), dtype=np.uint64)
+    # a*h + b stays below 2^63 because a, b < 2^31 and h < 2^32, so no uint64 wraparound
+    return ((np.outer(perm_a, hashes) + perm_b[:, None]) % mersenne_prime).min(axis=1)
+
+
+def lsh_candidate_pairs(word_lists):
+    """Returns sorted (a, b) pairs, a < b, of pages whose signatures collide in at least one LSH band.
+    Input: one list of words per page.
+
+    Pages sharing a site template tend to land in the same buckets, so a bucket can hold most of a school.
+    Pairing every member of a bucket would bring back the n^2 comparisons, so each member is only paired with
+    the next bucket_window members (in page order); the pages are still chained together, and each page
+    still meets several similar partners across bands. This keeps the number of pairs linear in pages."""
+
+    rows = minhash_perms // minhash_bands
+    signatures = [minhash_signature(words) for words in word_lists]
+    pairs = set()
+    for band in range(minhash_bands):
+        buckets = {}
+        for page, signature in enumerate(signatures):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            buckets.setdefault(key, []).append(page)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, min(i + 1 + bucket_window, len(members))):
+                    pairs.add((members[i], members[j]))
+    return sorted(pairs)
+
+
+# ## Site-template engine: drop lines shared by many pages of a school
+
+template_share = 0.5 # Drop a line if it appears on more than this share of a school's pages
+template_min_pages = 3 # Schools with fewer pages are returned unchanged: with 1-2 pages every shared line looks like template
+template_split = re.compile(r"(\n|\t)") # Units are lines/tab-separated cells; the capture group keeps separators for rejoining
+
+
+def remove_template_lines(pages, max_share=None, min_pages=None):
+    """Linear-time alternative to create_first_cut, generalizing seen_counts from Overlap_Parsing_Split.ipynb.
+    One pass hashes every (stripped, non-blank) line of every page and counts on how many pages it appears;
+    a second pass drops lines found on more than max_share of the pages (menus, headers, footers, addresses)
+    and keeps everything else in its original order with its original separators.
+    Input: list of page strings. Output: list of cut-down page strings, same length and order."""
+
+    if max_share is None:
+        max_share = template_share
+    if min_pages is None:
+        min_pages = template_min_pages
+    if len(pages) < min_pages:
+        return list(pages)
+
+    split_pages = [template_split.split(page or "") for page in pages]
+    page_counts = {}
+    for parts in split_pages:
+        for line in set(part.strip() for part in parts[0::2]): # Even positions are units, odd positions are separators
+            if line:
+                page_counts[line] = page_counts.get(line, 0) + 1
+
+    max_count = max_share * len(pages)
+    cut_pages = []
+    for parts in split_pages:
+        kept = []
+        for i in range(0, len(parts), 2):
+            if page_counts.get(parts[i].strip(), 0) > max_count:
+                continue # Template line: drop it along with the separator after it
+            kept.append(parts[i])
+            if i + 1 < len(parts):
+                kept.append(parts[i + 1])
+        cut_pages.append("".join(kept))
+    return cut_pages
+
+
+# ## Shared-prefix/suffix engine: headers and footers read off a sorted index of pages
+
+affix_min_pages = 3 # A prefix (suffix) is cut only if at least this many pages of the school start (end) with it
+token_pattern = re.compile(r"\S+") # Same tokens as str.split(), with their positions in the page
+
+
+def common_prefix_length(a, b):
+    """Returns the number of leading tokens two int32 token arrays share."""
+
+    m = min(len(a), len(b))
+    mismatch = np.flatnonzero(a[:m] != b[:m])
+    return int(mismatch[0]) if len(mismatch) > 0 else m
+
+
+def shared_prefix_lengths(token_ids, min_pages):
+    """For each page, returns the length of its longest token prefix that at least min_pages pages
+    (itself included) start with.
+    Pages are sorted lexicographically, so pages sharing a prefix are neighbours: a run of min_pages
+    consecutive pages shares the smallest common prefix of its adjacent pairs, and each page takes
+    the best run it belongs to. One sort plus one pass, instead of diffing every pair."""
+
+    n = len(token_ids)
+    lengths = [0] * n
+    if n < min_pages or min_pages < 2:
+        return lengths
+    order = sorted(range(n), key=lambda page: token_ids[page].tolist())
+    adjacent = [common_prefix_length(token_ids[order[i]], token_ids[order[i + 1]]) for i in range(n - 1)]
+    for start in range(n - min_pages + 1):
+        shared = min(adjacent[start:start + min_pages - 1])
+        for i in range(start, start + min_pages):
+            if shared > lengths[order[i]]:
+                lengths[order[i]] = shared
+    return lengths
+
+
+def remove_shared_affixes(pages, min_pages=None):
+    """Alternative to create_first_cut: cuts from each page the longest token prefix (header) and
+    token suffix (footer) it shares with at least min_pages pages of the school, found by sorting the pages
+    and, for footers, the pages reversed. What's left keeps its original whitespace.
+    Input: list of page strings. Output: list of cut-down page strings, same length and order."""
+
+    if min_pages is None:
+        min_pages = affix_min_pages
+    if len(pages) < min_pages:
+        return list(pages)
+
+    spans = [[match.span() for match in token_pattern.finditer(page or "")] for page in pages]
+    token_ids = intern_pages([[page[start:end] for start, end in page_spans] for page, page_spans in zip(pages, spans)])
+    headers = shared_prefix_lengths(token_ids, min_pages)
+    footers = shared_prefix_lengths([ids[::-1] for ids in token_ids], min_pages)
+
+    cut_pages = []
+    for page, page_spans, header, footer in zip(pages, spans, headers, footers):
+        last = len(page_spans) - footer # first footer token
+        if header >= last:
+            cut_pages.append("") # the whole page is shared header/footer
+        else:
+            cut_pages.append(page[page_spans[header][0]:page_spans[last - 1][1]])
+    return cut_pages
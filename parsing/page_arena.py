@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Read-only page-text arena shared by multiprocessing workers
+# Project title: Charter school identities
+#
+# Shipping per-school DataFrames or tuple lists to a multiprocessing.Pool pickles every page text into each task,
+# which for big schools costs more than the work itself. Instead, the parent writes all page text once into an arena:
+#     arena_path/
+#         text.bin                   every page's text as UTF-8, back to back
+#         offsets.npy, lengths.npy   byte offset and length of each page in text.bin (int64)
+#         hashes.npy                 64-bit content hash of each page (see page_store.page_hash)
+#         school_starts.npy          page index where each school starts; school k owns pages [starts[k], starts[k+1])
+#         school_ids.npy             school id (e.g. NCESSCH or DataFrame row) of each school
+#         meta.pkl                   (url, is_pdf, depth) of each page
+# Every worker memory-maps the same files (pages are shared by the OS page cache, not copied per process),
+# so tasks only need to carry a school index.
+#
+# Usage:
+#     build_arena(arena_path, enumerate(df["WEBTEXT"]))
+#     with mp.Pool(numcpus, initializer=open_arena, initargs=(arena_path,)) as p:
+#         results = p.map(worker_taking_school_index, range(len(df)))   # worker calls arena_school(k)
+
+
+import os # For navigation
+import mmap # For sharing text.bin between processes without copying
+import pickle # For page metadata
+import numpy as np # For offset arrays
+from page_store import tuple_hash # 64-bit page content hashes
+
+
+def build_arena(arena_path, schools):
+    """Writes an arena from an iterable of (school_id, list of page tuples), e.g. enumerate(df["WEBTEXT"]).
+    Cells that are not lists (NaN, '') are stored as schools without pages.
+    Output: Nothing (saves to disk)"""
+
+    os.makedirs(arena_path, exist_ok=True)
+    offsets, lengths, hashes, meta = [], [], [], []
+    school_ids, school_starts = [], []
+    position = 0
+
+    with open(os.path.join(arena_path, "text.bin"), "wb") as textfile:
+        for school_id, tuplist in schools:
+            school_ids.append(school_id)
+            school_starts.append(len(offsets))
+            if not isinstance(tuplist, list):
+                continue
+            for tup in tuplist:
+                text = tup[3] if tup[3] is not None else ""
+                encoded = text.encode("utf-8", "surrogatepass")
+                textfile.write(encoded)
+                offsets.append(position)
+                lengths.append(len(encoded))
+                hashes.append(tuple_hash(tup))
+                meta.append((tup[0], tup[1], tup[2]))
+                position += len(encoded)
+    school_starts.append(len(offsets))
+
+    np.save(os.path.join(arena_path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(arena_path, "lengths.npy"), np.array(lengths, dtype=np.int64))
+    np.save(os.path.join(arena_path, "hashes.npy"), np.array(hashes, dtype=np.int64))
+    np.save(os.path.join(arena_path, "school_starts.npy"), np.array(school_starts, dtype=np.int64))
+    np.save(os.path.join(arena_path, "school_ids.npy"), np.array(school_ids, dtype=object), allow_pickle=True)
+    with open(os.path.join(arena_path, "meta.pkl"), "wb") as metafile:
+        pickle.dump(meta, metafile, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class PageArena:
+    """Read-only view of an arena written by build_arena(). Text is decoded only when a page is asked for."""
+
+    def __init__(self, arena_path):
+        with open(os.path.join(arena_path, "text.bin"), "rb") as textfile:
+            # mmap can't map an empty file, which happens when every page is empty
+            self.text_map = mmap.mmap(textfile.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(textfile.name) > 0 else b""
+        self.offsets = np.load(os.path.join(arena_path, "offsets.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(arena_path, "lengths.npy"), mmap_mode="r")
+        self.hashes = np.load(os.path.join(arena_path, "hashes.npy"), mmap_mode="r")
+        self.school_starts = np.load(os.path.join(arena_path, "school_starts.npy"))
+        self.school_ids = np.load(os.path.join(arena_path, "school_ids.npy"), allow_pickle=True)
+        with open(os.path.join(arena_path, "meta.pkl"), "rb") as metafile:
+            self.meta = pickle.load(metafile)
+
+    def __len__(self):
+        return len(self.school_ids)
+
+    def page_range(self, k):
+        """Returns the range of page indexes owned by school k."""
+        return range(self.school_starts[k], self.school_starts[k + 1])
+
+    def school_sizes(self):
+        """Returns (pages, text bytes) per school as two int64 arrays, without reading any text."""
+        pages = np.diff(self.school_starts)
+        cumulative = np.concatenate(([0], np.cumsum(self.lengths, dtype=np.int64)))
+        return pages, cumulative[self.school_starts[1:]] - cumulative[self.school_starts[:-1]]
+
+    def page_bytes(self, i):
+        """Returns a memoryview of page i's UTF-8 text, without copying it out of the map."""
+        return memoryview(self.text_map)[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    def page_text(self, i):
+        return str(self.page_bytes(i), "utf-8", "surrogatepass")
+
+    def school_tuples(self, k):
+        """Returns school k as a list of (url, is_pdf, depth, text, hash) tuples.
+        The 5th field lets page_key() dedup on the stored hash instead of the text."""
+        return [self.meta[i] + (self.page_text(i), int(self.hashes[i])) for i in self.page_range(k)]
+
+
+arena = None # Set in each worker by open_arena()
+
+
+def open_arena(arena_path):
+    """Pool initializer: maps the arena once per worker process."""
+
+    global arena
+    arena = PageArena(arena_path)
+
+
+def arena_school(k):
+    """Returns school k of this worker's arena as a list of page tuples."""
+
+    return arena.school_tuples(k)
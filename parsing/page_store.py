@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Columnar page store: one row per page, one Parquet file per school
+# Project title: Charter school identities
+#
+# Replaces pickled DataFrames whose WEBTEXT/CMO_WEBTEXT cells hold lists of (url, is_pdf, depth, text) tuples.
+# Layout on disk:
+#     store_path/
+#         <NCESSCH>_<n>.parquet    columns: NCESSCH, crawl_id, url, is_pdf, depth, text, hash
+# where n numbers the rows sharing an NCESSCH in the school list, in order (see partition_keys()). URL lists with
+# repeated or mangled ids (e.g. 1.20E+11 in charter_URLs_2014.csv) thus still give every school its own partition.
+# Readers get back the same tuple lists the rest of the pipeline expects, one school at a time,
+# and can ask for only the columns they need (e.g. skip 'text' when only counting pages).
+# 'hash' is a 64-bit content hash of 'text' computed once at write time; dedup checks in later stages
+# compare these integers when they have them, instead of multi-KB strings (see page_key()).
+# With a blob_store.BlobStore passed as blobs=, 'text' is left out of the partitions and each distinct body is kept
+# once, compressed, in the blob store; readers asking for 'text' get it back from there by hash.
+#
+# Usage:
+#     from page_store import iter_schools, load_school
+#     for ncessch, tuplist in iter_schools("../../nowdata/webtext_store"):
+#         ...
+
+
+import os # For navigation
+from hashlib import blake2b # Fast keyed hash with configurable digest size
+import pandas as pd # For working with dataframes
+
+
+page_columns = ["url", "is_pdf", "depth", "text"] # Order of fields in a page tuple
+hashed_columns = page_columns + ["hash"] # Pass as columns= to get 5-tuples carrying the stored content hash
+store_columns = ["NCESSCH", "crawl_id"] + hashed_columns
+
+
+def as_bool(flag):
+    """Returns a page flag (e.g. is_pdf) as a bool. The crawl stores flags as the strings 'True'/'False',
+    which are both truthy, so they are parsed explicitly; real bools and 0/1 pass through."""
+
+    if isinstance(flag, str):
+        return flag.strip() in ("True", "true", "1")
+    return bool(flag)
+
+
+def page_hash(text):
+    """Returns a 64-bit content hash of page text as a signed int (fits a Parquet int64 column).
+    Equal texts always give equal hashes, across processes and runs (unlike the built-in hash())."""
+
+    if text is None:
+        text = ""
+    return int.from_bytes(blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little", signed=True)
+
+
+def tuple_hash(tup):
+    """Returns the content hash of a page tuple: the stored 5th field if read with hashed_columns,
+    otherwise computed from the text (4th field)."""
+
+    if len(tup) > 4:
+        return tup[4]
+    return page_hash(tup[3])
+
+
+def page_key(tup):
+    """Returns the dedup key of a page tuple (for known_pages/seen_pages sets): the stored content hash if the tuple
+    carries one (read with hashed_columns, or from a page_arena), otherwise the text itself.
+    Python caches a string's hash, so a set of texts is cheaper than hashing text that has no stored hash.
+    Only compare keys of tuples from the same source: a hash never equals a text."""
+
+    if len(tup) > 4:
+        return tup[4]
+    return tup[3]
+
+
+def pages_hash(tuplist):
+    """Returns a 64-bit hash of a whole list of page tuples: urls, flags, depths and text hashes, in order.
+    Equal lists give equal hashes, e.g. the CMO_WEBTEXT copies of schools run by the same CMO."""
+
+    digest = blake2b(digest_size=8)
+    for tup in tuplist:
+        key = (tup[0], tup[1], tup[2], tuple_hash(tup)) if (tup is not None) and (len(tup) > 3) else tup
+        digest.update(repr(key).encode("utf-8", "surrogatepass") + b"\n")
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+def school_key(ncessch, occurrence=0):
+    """Returns the partition key of the occurrence-th row with id ncessch, e.g. '62223008323_0'.
+    NCESSCH ids read from CSV come back as floats (e.g. 62223008323.0), so they are normalized to integer strings."""
+
+    return str(int(float(ncessch))) + "_" + str(occurrence)
+
+
+def key_ncessch(key):
+    """Returns the NCESSCH id (int) of a partition key."""
+    return int(key.rsplit("_", 1)[0])
+
+
+def id_occurrences(df, id_column="NCESSCH"):
+    """Returns (normalized id, occurrence number) for each row of df: the id as an integer string ('' if missing)
+    and how many earlier rows share it. Shared by partition_keys() and shard_manifest.school_keys(), so page store
+    partitions and run manifests key the same row the same way."""
+
+    ids = df[id_column].map(lambda ncessch: "" if str(ncessch) == 'nan' else str(int(float(ncessch))))
+    occurrence = ids.groupby(ids, sort=False).cumcount()
+    return [(ncessch, int(n)) for ncessch, n in zip(ids, occurrence)]
+
+
+def partition_keys(df, id_column="NCESSCH"):
+    """Returns the partition key of each row of df: its id plus its occurrence number among rows with that id.
+    Rows with a missing id get None."""
+
+    return [school_key(ncessch, n) if ncessch else None for ncessch, n in id_occurrences(df, id_column)]
+
+
+def school_path(store_path, key):
+    """Returns the path of the partition with the given key (see school_key())."""
+
+    return os.path.join(store_path, key + ".parquet")
+
+
+def write_school(store_path, key, crawl_id, pages, blobs=None):
+    """Writes (or replaces) the partition for one school.
+    If blobs (a BlobStore) is given, page text goes to the blob store and the partition keeps only its hash.
+    Input: store directory, partition key (see partition_keys()), crawl id, list of (url, is_pdf, depth, text) tuples
+    Output: Nothing (saves to disk)"""
+
+    os.makedirs(store_path, exist_ok=True)
+    school_df = pd.DataFrame([tuple(page[:4]) for page in pages], columns=page_columns)
+    school_df["hash"] = [page_hash(page[3]) for page in pages] # Computed once here, reused by every later stage
+    if blobs is not None:
+        blobs.put_many(school_df["text"].tolist(), school_df["hash"].tolist())
+        school_df = school_df.drop(columns="text")
+    school_df.insert(0, "crawl_id", crawl_id)
+    school_df.insert(0, "NCESSCH", key_ncessch(key))
+
+    # Write to a temporary file first so a crash never leaves a half-written partition behind;
+    # the name carries the pid, so parallel ingest workers never write to the same temporary file
+    tmp_path = school_path(store_path, key) + "." + str(os.getpid()) + ".tmp"
+    school_df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, school_path(store_path, key))
+
+
+def list_schools(store_path):
+    """Returns the partition keys in store_path, sorted by NCESSCH and occurrence."""
+
+    if not os.path.isdir(store_path):
+        return []
+    keys = [fname[:-len(".parquet")] for fname in os.listdir(store_path) if fname.endswith(".parquet")]
+    return sorted(keys, key=lambda key: (key_ncessch(key), int(key.rsplit("_", 1)[1])))
+
+
+def load_school_df(store_path, key, columns=None, blobs=None):
+    """Loads one school's partition as a DataFrame with one row per page, reading only the given columns.
+    If blobs is given, 'text' is fetched from the blob store by hash."""
+
+    if blobs is None or (columns is not None and "text" not in columns):
+        return pd.read_parquet(school_path(store_path, key), columns=columns)
+
+    read_columns = None if columns is None else [col for col in columns if col != "text"] + (["hash"] if "hash" not in columns else [])
+    school_df = pd.read_parquet(school_path(store_path, key), columns=read_columns)
+    school_df["text"] = blobs.get_many(school_df["hash"].tolist())
+    return school_df[columns if columns is not None else [col for col in store_columns if col in school_df.columns]]
+
+
+def load_school(store_path, key, columns=None, blobs=None):
+    """Loads one school as a list of page tuples.
+    By default tuples are (url, is_pdf, depth, text), matching the WEBTEXT column;
+    pass hashed_columns to append the stored content hash, or a subset of columns to skip reading the rest from disk.
+    Pass blobs (a BlobStore) for stores written with one."""
+
+    if columns is None:
+        columns = page_columns
+    school_df = load_school_df(store_path, key, columns, blobs)
+    return list(zip(*[school_df[col].tolist() for col in columns]))
+
+
+def iter_schools(store_path, key_list=None, columns=None, blobs=None):
+    """Lazily yields (NCESSCH, list of page tuples) for each school in store_path (or only those in key_list).
+    Schools listed more than once in the school list are yielded once per partition."""
+
+    if key_list is None:
+        key_list = list_schools(store_path)
+    for key in key_list:
+        yield key_ncessch(key), load_school(store_path, key, columns, blobs)
+
+
+def load_store_df(store_path, column="WEBTEXT", columns=None, blobs=None):
+    """Builds a DataFrame shaped like the old pickles: one row per school with NCESSCH and a column of page tuple lists.
+    Useful as a drop-in for pd.read_pickle() in stages that still work on whole DataFrames."""
+
+    ncessch_list, tuplists = [], []
+    for ncessch, tuplist in iter_schools(store_path, columns=columns, blobs=blobs):
+        ncessch_list.append(ncessch)
+        tuplists.append(tuplist)
+    return pd.DataFrame({"NCESSCH": ncessch_list, column: tuplists})
+
+
+def store_from_df(df, store_path, column="WEBTEXT", id_column="NCESSCH", crawl_column=None, blobs=None):
+    """Converts an existing DataFrame of page tuple lists (e.g. charters_full_2015.pkl, or a TSV already run
+    through ast.literal_eval) into a page store, one partition per row, so repeated ids keep all their rows.
+    Rows with a missing id are skipped. Pass blobs (a BlobStore) to keep page bodies in the content-addressed blob store."""
+
+    keys = partition_keys(df, id_column)
+    for i, tuplist in enumerate(df[column]):
+        if keys[i] is None:
+            continue
+        if not isinstance(tuplist, list):
+            tuplist = [] # NaN or '' placeholders for schools without pages
+        crawl_id = df[crawl_column].iloc[i] if crawl_column else -1
+        write_school(store_path, keys[i], crawl_id, tuplist, blobs)
@@ -1,51 +1,251 @@
 import sqlite3
 import csv
 import pandas as pd
+import numpy as np
 import os
+import json
+import multiprocessing as mp
+from itertools import groupby
+from page_store import as_bool, partition_keys, write_school
+from blob_store import BlobStore
 
 def valid_page(page):
     crawl_id, url, is_pdf, cur_depth, body = page
+    if skip_pdfs and as_bool(is_pdf):
+        return False
+    if max_depth is not None and int(cur_depth) > max_depth:
+        return False
     return True
 
+def page_predicates():
+    """Returns (SQL condition, params) equivalent to valid_page(), so rejected pages are filtered
+    by SQLite and their bodies never cross the cursor.
+    The crawl stores is_pdf as 'True'/'False' and curdepth as text, so both are compared as valid_page() reads them."""
+    conditions, params = [], []
+    if skip_pdfs:
+        conditions.append("COALESCE(is_pdf, 0) NOT IN ('True', 'true', '1', 1)")
+    if max_depth is not None:
+        conditions.append("CAST(curdepth AS INTEGER) <= ?")
+        params.append(max_depth)
+    return " AND ".join(conditions), params
+
+def page_query(where="", params=[]):
+    """Builds the dump query with valid_page() pushed down as SQL predicates, plus any extra condition."""
+    conditions, all_params = page_predicates()
+    conditions = [cond for cond in [conditions, where] if cond]
+    query = "SELECT crawlid, response_url, is_pdf, curdepth, body FROM dump"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY crawlid", all_params + list(params)
+
+def iter_rows(cursor, batch_size=1000):
+    """Yields rows from an executed cursor, pulling batch_size rows at a time with fetchmany()
+    so the whole dump table never has to sit in memory."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def iter_schools(rows):
+    """Groups rows ordered by crawlid into (crawl_id, pages) pairs, one school at a time.
+    Invalid pages are dropped. pages is a list of (url, is_pdf, depth, body) tuples."""
+    for crawlid, group in groupby(rows, key=lambda row: row[0]):
+        yield int(crawlid.split("_")[-1]), [row[1:] for row in group if valid_page(row)]
+
+def school_table(urls_path):
+    """Loads the charter URL list and keys it by crawl id. Crawl ids are the 1-based row numbers of the URL list."""
+    df_csv = pd.read_csv(urls_path)
+    df_csv["crawl_id"] = np.arange(1, len(df_csv) + 1)
+    return df_csv
+
+def report_unmatched(schools, crawl_ids):
+    """Prints schools in the URL list without a crawl, and crawl ids without a school in the URL list."""
+    crawl_ids = pd.Series(crawl_ids)
+    no_crawl = schools[~schools["crawl_id"].isin(crawl_ids)]
+    no_school = crawl_ids[~crawl_ids.isin(schools["crawl_id"])]
+    print(str(len(no_crawl)) + " schools in URL list have no crawl (NCESSCH: " + str(no_crawl["NCESSCH"].tolist()[:20]) + (" ...)" if len(no_crawl) > 20 else ")"))
+    if len(no_school) > 0:
+        print(str(len(no_school)) + " crawl ids have no school in URL list: " + str(no_school.tolist()[:20]))
+    return no_crawl
+
+def join_crawls(df, schools):
+    """Joins grouped crawl data (columns crawl_id, pages) onto the school list by crawl id in one vectorized merge.
+    Schools without a crawl keep an empty 'data' cell; unmatched ids on either side are reported."""
+    report_unmatched(schools, df["crawl_id"])
+    merged_df = schools.merge(df, on="crawl_id", how="left", validate="one_to_one")
+    merged_df["data"] = merged_df["pages"].where(merged_df["pages"].notna(), "")
+    return merged_df.drop(columns="pages")
+
+def shard_bounds(cursor, numshards):
+    """Splits the distinct crawlids of the dump table into numshards contiguous ranges, in ORDER BY crawlid order.
+    Returns shards as (SQL condition, params) pairs for ingest_shard()."""
+    crawlids = [row[0] for row in cursor.execute("SELECT DISTINCT crawlid FROM dump ORDER BY crawlid")]
+    return [("crawlid BETWEEN ? AND ?", [shard[0], shard[-1]]) for shard in np.array_split(np.array(crawlids, dtype=object), numshards) if len(shard) > 0]
+
+def crawlid_shards(crawlids, shard_size=500):
+    """Splits an explicit list of crawlids into IN (...) shards small enough for SQLite's bound-parameter limit."""
+    return [("crawlid IN (" + ",".join(["?"] * len(crawlids[i:i + shard_size])) + ")", crawlids[i:i + shard_size])
+            for i in range(0, len(crawlids), shard_size)]
+
+def ingest_shard(shard):
+    """Reads the schools matching one shard's (SQL condition, params) over its own read-only connection
+    and writes each school to the page store, replacing any earlier partition.
+    Returns crawl ids seen, so unmatched ones can be reported by the parent."""
+    shard_conn = sqlite3.connect('file:' + db_path + '?mode=ro', uri=True, timeout=30)
+    shard_c = shard_conn.cursor()
+    blobs = BlobStore(blob_path) if blob_path else None # Opened per worker: SQLite connections can't cross a fork
+    shard_c.execute(*page_query(*shard))
+    seen_crawl_ids = []
+    for crawl_id, pages in iter_schools(iter_rows(shard_c, batch_size)):
+        seen_crawl_ids.append(crawl_id)
+        if key_by_crawl.get(crawl_id) is not None:
+            write_school(store_path, key_by_crawl[crawl_id], crawl_id, pages, blobs)
+    shard_conn.close()
+    if blobs is not None:
+        blobs.close()
+    return seen_crawl_ids
+
+def train_blob_dictionary(cursor, sample_size=5000):
+    """Trains the blob store's compression dictionary on a random sample of page bodies, if not trained yet.
+    Random rowids are drawn first and only their bodies are read (ORDER BY RANDOM() would read every body in the dump);
+    rowids left by deleted rows are just missing from the sample."""
+    blobs = BlobStore(blob_path)
+    if not blobs.trained():
+        print("Training blob dictionary on " + str(sample_size) + " sample pages")
+        cursor.execute("SELECT MAX(rowid) FROM dump")
+        max_rowid = cursor.fetchone()[0] or 0
+        rowids = (np.random.choice(max_rowid, min(sample_size, max_rowid), replace=False) + 1).tolist()
+        bodies = []
+        for i in range(0, len(rowids), 500): # Stay under SQLite's bound-parameter limit
+            cursor.execute("SELECT body FROM dump WHERE rowid IN (" + ",".join(["?"] * len(rowids[i:i + 500])) + ")", rowids[i:i + 500])
+            bodies.extend(row[0] for row in cursor.fetchall() if isinstance(row[0], str))
+        blobs.train(bodies)
+    blobs.close()
+
+def load_state(state_path):
+    """Loads the ingest high-water mark. A missing file means nothing has been ingested yet."""
+    if not os.path.exists(state_path):
+        return {"last_rowid": 0, "last_timestamp": None, "last_crawlid": None}
+    with open(state_path) as statefile:
+        return json.load(statefile)
+
+def save_state(state, state_path):
+    """Atomically saves the ingest high-water mark, so an interrupted run never leaves a mark ahead of the store."""
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + ".tmp", "w") as statefile:
+        json.dump(state, statefile)
+    os.replace(state_path + ".tmp", state_path)
+
+def high_water_mark(cursor):
+    """Returns the current end of the dump table: largest rowid (rows are only ever appended by the crawler),
+    latest row timestamp if timestamp_column is set, and the crawlid of the last row."""
+    cursor.execute("SELECT MAX(rowid) FROM dump")
+    last_rowid = cursor.fetchone()[0] or 0
+    cursor.execute("SELECT crawlid FROM dump WHERE rowid = ?", (last_rowid,))
+    last_crawlid = (cursor.fetchone() or [None])[0]
+    last_timestamp = None
+    if timestamp_column:
+        cursor.execute("SELECT MAX(" + timestamp_column + ") FROM dump")
+        last_timestamp = cursor.fetchone()[0]
+    return {"last_rowid": last_rowid, "last_timestamp": last_timestamp, "last_crawlid": last_crawlid}
+
+def changed_crawlids(cursor, state, mark):
+    """Returns crawlids with rows added (or, with timestamp_column, updated) since state and up to mark.
+    All rows of these crawls are re-read, so their partitions end up as a full re-ingest would leave them."""
+    conditions, params = ["rowid > ? AND rowid <= ?"], [state["last_rowid"], mark["last_rowid"]]
+    if timestamp_column and state["last_timestamp"] is not None:
+        conditions = ["(" + conditions[0] + " OR " + timestamp_column + " > ?)"]
+        params.append(state["last_timestamp"])
+    cursor.execute("SELECT DISTINCT crawlid FROM dump WHERE " + conditions[0] + " ORDER BY crawlid", params)
+    return [row[0] for row in cursor.fetchall()]
+
+parallel = True # Set to 'True' to read crawlid ranges in a process pool, one read-only connection per worker; writes to the page store like streaming
+streaming = True # Set to 'True' to group and write each school as soon as its rows are read; peak memory then scales with the largest school, not the whole crawl
+batch_size = 1000 # Rows pulled from the cursor per fetchmany() call when streaming
+skip_pdfs = False # Set to 'True' to drop PDF pages (is_pdf) before they are read
+max_depth = None # Drop pages crawled deeper than this (curdepth); None keeps all depths
+numcpus = len(os.sched_getaffinity(0)) # Detect and assign number of available CPUs
+numshards = numcpus * 4 # More shards than workers so schools of uneven size balance out
+incremental = False # Set to 'True' to only re-read crawls added or changed since the last run recorded in state_path (parallel or streaming mode)
+timestamp_column = None # Name of the row timestamp column in dump, if the crawler records one; lets incremental runs catch rows updated in place
+
 pickled_df = "../../processed_df.pkl"
+urls_path = "../data/charter_URLs_2016.csv" # or charter_URLs_2014.csv
+store_path = "../../webtext_store" # Directory of per-school page partitions, read back with page_store.iter_schools()
+state_path = os.path.join(store_path, "_ingest_state.json") # High-water mark of the last run that wrote to store_path
+blob_path = None # e.g. "../../page_blobs.db": keep each distinct body once, zstd-compressed, instead of in the store's 'text' column
 
-conn = sqlite3.connect('/vol_b/data/scrapy_cluster_data/data.db', timeout=30)
+db_path = '/vol_b/data/scrapy_cluster_data/data.db'
+conn = sqlite3.connect(db_path, timeout=30)
 c = conn.cursor()
-print("Beginning data fetch")
-data = c.execute("""SELECT crawlid, response_url, is_pdf, curdepth, body FROM dump ORDER BY crawlid""").fetchall()
-print("Finished fetching data")
-c.close()
-
-filtered_data = []
-cur_crawlid, cur_row = data[0][0], []
-
-print("Beginning grouping and filtering")
-for i in range(len(data)):
-    if data[i][0] != cur_crawlid:
-        filtered_data.append((cur_crawlid, cur_row))
-        cur_row = []
-        cur_crawlid = data[i][0]
-    if valid_page(data[i]):
-        cur_row.append(data[i][1:])
-filtered_data.append((cur_crawlid, cur_row))
-data = filtered_data
-data = [[int(data[i][0].split("_")[-1]), data[i][1]] for i in range(len(data))]
-print("Finished grouping and filtering")
-
-print("Creating df")
-df = pd.DataFrame(data)
-df.columns = ["crawl_id", "pages"]
-df = df.sort_values(by="crawl_id")
-print("Finished creating df")
-
-df_csv = pd.read_csv('../data/charter_URLs_2016.csv')
-df_csv["data"] = ""
-
-print("Merging dataframes")
-merged_df = df_csv.copy()
-i = 0
-for index, row in df_csv.iterrows():
-    if df.iloc[i][0] == index + 1:
-        merged_df.at[index, "data"] = df.iloc[i][1]
-        i += 1
-merged_df.to_pickle(pickled_df)
+
+if parallel or streaming:
+    schools = school_table(urls_path)
+    key_by_crawl = dict(zip(schools["crawl_id"], partition_keys(schools))) # Page store partition of each crawl (NCESSCH plus occurrence, so repeated ids don't collide); inherited by forked workers
+
+    if parallel or incremental:
+        c.execute("CREATE INDEX IF NOT EXISTS dump_crawlid ON dump (crawlid)") # Range and IN reads need this; built once, reused by later runs
+        conn.commit()
+    mark = high_water_mark(c) # Taken before reading, so rows appended during this run are picked up by the next one
+    if blob_path:
+        train_blob_dictionary(c)
+    if incremental:
+        state = load_state(state_path)
+        crawlids = changed_crawlids(c, state, mark)
+        print(str(len(crawlids)) + " crawls new or changed since row " + str(state["last_rowid"]))
+        shards = crawlid_shards(crawlids)
+    elif parallel:
+        shards = shard_bounds(c, numshards)
+    else:
+        shards = [("", [])] # One shard covering the whole table, read over a single cursor
+    c.close()
+
+    seen_crawl_ids = []
+    if parallel:
+        print("Beginning parallel fetch of " + str(len(shards)) + " shards on " + str(numcpus) + " CPUs")
+        with mp.Pool(processes=numcpus) as p:
+            for shard_crawl_ids in p.imap_unordered(ingest_shard, shards):
+                seen_crawl_ids.extend(shard_crawl_ids)
+    else:
+        print("Beginning streaming fetch, grouping and filtering")
+        for shard in shards:
+            seen_crawl_ids.extend(ingest_shard(shard))
+    print("Finished writing " + str(len(seen_crawl_ids)) + " crawls to " + store_path)
+
+    if not incremental:
+        report_unmatched(schools, seen_crawl_ids)
+    save_state(mark, state_path)
+
+else:
+    print("Beginning data fetch")
+    data = c.execute(*page_query()).fetchall()
+    print("Finished fetching data")
+    c.close()
+
+    filtered_data = []
+    cur_crawlid, cur_row = data[0][0], []
+
+    print("Beginning grouping and filtering")
+    for i in range(len(data)):
+        if data[i][0] != cur_crawlid:
+            filtered_data.append((cur_crawlid, cur_row))
+            cur_row = []
+            cur_crawlid = data[i][0]
+        if valid_page(data[i]):
+            cur_row.append(data[i][1:])
+    filtered_data.append((cur_crawlid, cur_row))
+    data = filtered_data
+    data = [[int(data[i][0].split("_")[-1]), data[i][1]] for i in range(len(data))]
+    print("Finished grouping and filtering")
+
+    print("Creating df")
+    df = pd.DataFrame(data)
+    df.columns = ["crawl_id", "pages"]
+    df = df.sort_values(by="crawl_id")
+    print("Finished creating df")
+
+    print("Merging dataframes")
+    merged_df = join_crawls(df, school_table(urls_path))
+    merged_df.to_pickle(pickled_df)
@@ -37,6 +37,7 @@ sys.path.insert(0, '../../data_tools/')
 from clean_text import stopwords_make, punctstr_make, unicode_make, clean_sentence
 from quickpickle import quickpickle_dump, quickpickle_load # For quickly loading & saving pickle files in Python
 from df_tools import check_df, load_filtered_df # For quick DF stats
+from page_store import page_key # Page dedup keys
 
 # Define stopwords, unicode, punctstr
 stop_words_list = stopwords_make()
@@ -55,7 +56,7 @@ def master_string_make(tupslist):
     
 
     len_site = len(tupslist) # Count number of pages
-    known_pages = set() # Initialize list of known pages for a school
+    known_pages = set() # Initialize set of keys of known pages for a school
     school_string = '' # Initialize master string for text of all a school's pages
             
     # Iterate over pages
@@ -64,7 +65,8 @@ def master_string_make(tupslist):
                 
     for pagenum in range(len_site):
         sents_combined = ''
-        if (tupslist[pagenum][3] in known_pages) or (tupslist[pagenum][3]==''): 
+        key = page_key(tupslist[pagenum]) # Content hash stored at ingest, or the text itself
+        if (key in known_pages) or (tupslist[pagenum][3]==''): 
             continue # Skip this page if exactly the same as a previous page on this school's website
                 
         for chunk in tupslist[pagenum][3].split("\n"): # Iterate over text chunks
@@ -83,7 +85,7 @@ def master_string_make(tupslist):
                     
                 sents_combined += ('\n' + sent) # Add sentence to list of sentences
 
-        known_pages.add(tupslist[pagenum][3]) # Add page to known page list
+        known_pages.add(key) # Add page to known page set
         school_string += ('\n' + sents_combined) # Add to master string 
                             
     if school_string != '' and school_string not in ["", "\n", 0, "0"] and len(school_string)>0 and school_string != None:
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# Checkpoint/resume manifest for long parsing runs
+# Project title: Charter school identities
+#
+# Long runs (e.g. overlap removal on the large VM) write their results as numbered shards:
+#     output_dir/
+#         shard_00000.parquet, shard_00001.parquet, ...    finished rows, in input order within each shard
+#         _manifest.json                                   {"done": [school keys], "shards": [shard file names]}
+# Shards are written as schools finish, not in input order, so a crash only loses the rows not yet in a shard.
+# "done" lists the keys of the shard rows in the same order as the rows, so load_shards(..., keys=...) can put them
+# back in input order.
+# A shard is written to a temporary file and renamed first, then the manifest is replaced the same way,
+# so the manifest only ever lists complete shards. A run that dies between the two leaves an unlisted
+# shard behind, which the next run overwrites under the same number.
+# On restart, rows whose key is already in "done" are skipped. This replaces piecing parsed_df_1..N.csv
+# together by hand in Lookup_Table.ipynb.
+#
+# Shards are typed Parquet files. Page-list columns (WEBTEXT, CMO_WEBTEXT) whose cells are lists of page tuples are
+# stored as nested records list<struct<url, is_pdf, depth, text>> instead of Python list reprs in a CSV, so readers
+# get the tuple lists back directly, without ast.literal_eval, and the zstd-compressed files are much smaller.
+# A page-list column still holding list reprs (e.g. WEBTEXT read from a CSV) is kept as it is, as strings.
+#
+# Usage:
+#     keys = school_keys(df)
+#     manifest = load_manifest(output_dir)
+#     for rows in batches of pending_rows(keys, manifest):
+#         write_shard(parsed_df_for(rows), output_dir, manifest, [keys[row] for row in rows])
+#     full_df = load_shards(output_dir, keys=keys)   # input order; or: for shard_df in iter_shards(output_dir), one shard at a time
+
+
+import os # For navigation
+import json # For the manifest
+import pandas as pd
+import pyarrow as pa # For nested page records
+import pyarrow.parquet as pq
+from page_store import id_occurrences, school_key # Same row keys as the page store
+
+
+list_columns = ["WEBTEXT", "CMO_WEBTEXT"] # Columns holding lists of (url, is_pdf, depth, text) page tuples
+page_fields = ["url", "is_pdf", "depth", "text"]
+
+
+def school_keys(df, id_column="NCESSCH"):
+    """Returns a key per row of df: its page store partition key (e.g. '60000000000_0', see page_store.partition_keys()),
+    or 'nan_<n>' for the n-th row with a missing id, so repeated or missing ids still give every row its own stable key.
+    Ids are normalized like the page store's, so 60000000000 and 60000000000.0 give the same key."""
+
+    return [school_key(ncessch, n) if ncessch else "nan_" + str(n) for ncessch, n in id_occurrences(df, id_column)]
+
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, "_manifest.json")
+
+
+def shard_path(output_dir, number):
+    return os.path.join(output_dir, "shard_" + str(number).zfill(5) + ".parquet")
+
+
+def load_manifest(output_dir):
+    """Loads the manifest of a run. A missing file means nothing has been finished yet."""
+    if not os.path.exists(manifest_path(output_dir)):
+        return {"done": [], "shards": []}
+    with open(manifest_path(output_dir)) as manifestfile:
+        return json.load(manifestfile)
+
+
+def save_manifest(manifest, output_dir):
+    """Atomically saves the manifest, so an interrupted run never lists a shard that isn't fully written."""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_path(output_dir) + ".tmp", "w") as manifestfile:
+        json.dump(manifest, manifestfile)
+    os.replace(manifest_path(output_dir) + ".tmp", manifest_path(output_dir))
+
+
+def pending_rows(keys, manifest):
+    """Returns the positions of rows whose key is not yet done, in order.
+    Raises ValueError if the manifest lists keys this input doesn't have (a different school list, or a manifest
+    written before keys were normalized), since resuming would then mix rows of two runs."""
+    done = set(manifest["done"])
+    stale = done.difference(keys)
+    if stale:
+        raise ValueError(str(len(stale)) + " done keys in the manifest (e.g. " + repr(sorted(stale)[0]) + ") are not keys of this input; start the run in a fresh output_dir")
+    return [row for row, key in enumerate(keys) if key not in done]
+
+
+def missing(cell):
+    """True for empty cells (None or NaN), which are stored as null."""
+    return (cell is None) or (isinstance(cell, float) and cell != cell)
+
+
+def page_records(tuplist):
+    """Converts a list of page tuples into records for a list<struct> column (None or NaN become null)."""
+    if missing(tuplist):
+        return None
+    if not isinstance(tuplist, list):
+        raise ValueError("expected a list of page tuples, got " + type(tuplist).__name__ + ": " + repr(tuplist)[:100])
+    return [None if tup is None else dict(zip(page_fields, tup[:4])) for tup in tuplist]
+
+
+def page_tuples(records):
+    """Inverse of page_records()."""
+    if records is None:
+        return None
+    return [None if record is None else tuple(record[field] for field in page_fields) for record in records]
+
+
+def nested_columns(df):
+    """Returns the page-list columns of df whose cells are lists, to be stored as nested page records.
+    Columns without any list (e.g. list reprs read from a CSV) are stored as they are; a column mixing lists
+    with other values raises ValueError instead of losing them."""
+
+    nested = []
+    for column in df.columns:
+        if column not in list_columns:
+            continue
+        is_list = df[column].map(lambda cell: isinstance(cell, list))
+        if not is_list.any():
+            continue
+        other = df[column][~is_list & ~df[column].map(missing)]
+        if len(other) > 0:
+            raise ValueError("column " + column + " mixes page lists with " + str(len(other)) + " other values, e.g. " + repr(other.iloc[0])[:100])
+        nested.append(column)
+    return nested
+
+
+def shard_table(df):
+    """Returns df as an Arrow table, with its page-list columns as nested page records."""
+    nested = nested_columns(df)
+    table = pa.Table.from_pandas(df.drop(columns=nested), preserve_index=False)
+    for column in nested:
+        table = table.append_column(column, pa.array([page_records(tuplist) for tuplist in df[column]]))
+    return table.select(list(df.columns)) # Original column order
+
+
+def write_shard(df, output_dir, manifest, keys):
+    """Saves df as the next shard, then records it and its row keys as done in the manifest (updated in place).
+    Output: Nothing (saves to disk)"""
+
+    os.makedirs(output_dir, exist_ok=True)
+    number = len(manifest["shards"])
+    tmp_path = shard_path(output_dir, number) + ".tmp"
+    pq.write_table(shard_table(df), tmp_path, compression="zstd")
+    os.replace(tmp_path, shard_path(output_dir, number))
+
+    manifest["shards"].append(os.path.basename(shard_path(output_dir, number)))
+    manifest["done"].extend(keys)
+    save_manifest(manifest, output_dir)
+
+
+def read_shard(path, columns=None):
+    """Reads one shard as a DataFrame, with page-list columns back as lists of page tuples.
+    Pass columns= to read only some columns (e.g. leave out the page lists when only ids are needed)."""
+
+    table = pq.read_table(path, columns=columns)
+    nested = [column for column in table.column_names if pa.types.is_list(table.schema.field(column).type)]
+    df = table.drop_columns(nested).to_pandas()
+    for column in nested:
+        df[column] = [page_tuples(records) for records in table.column(column).to_pylist()]
+    return df[table.column_names]
+
+
+def iter_shards(output_dir, columns=None):
+    """Yields the shards listed in the manifest one DataFrame at a time, in shard order."""
+
+    for shard in load_manifest(output_dir)["shards"]:
+        yield read_shard(os.path.join(output_dir, shard), columns)
+
+
+def load_shards(output_dir, columns=None, keys=None):
+    """Reads every shard listed in the manifest back into one DataFrame, in shard order.
+    Pass the run's keys (school_keys() of its input) to get the rows back in input order instead."""
+
+    shards = list(iter_shards(output_dir, columns))
+    if len(shards) == 0:
+        return pd.DataFrame()
+    df = pd.concat(shards, ignore_index=True)
+    if keys is not None:
+        position = {key: i for i, key in enumerate(keys)}
+        done = load_manifest(output_dir)["done"]
+        df = df.iloc[sorted(range(len(df)), key=lambda row: position[done[row]])].reset_index(drop=True)
+    return df